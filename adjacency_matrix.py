@@ -1,110 +1,150 @@
+import json
+import os
 import sys
-if len(sys.argv) < 2:
-    print >>sys.stderr, "adjacency_matrix.py topology"
-    sys.exit(1)
-f = open(sys.argv[1])
-as_assigned = 1
-as_map = {}
-as_rev_map = {}
-links = {}
-link_map = {}
-link_rev_map = {}
-relationship = {}
-relationships = {}
-for l in f:
-    p = l.strip().split()
-    if p[0] not in as_map:
-        as_map[p[0]] = as_assigned
-        as_rev_map[as_assigned] = p[0]
-        as_assigned += 1
-    if p[1] not in as_map:
-        as_map[p[1]] = as_assigned
-        as_rev_map[as_assigned] = p[1]
-        as_assigned += 1
-    if p[0] not in links:
-        links[p[0]] = []
-        relationship[p[0]] = {}
-        relationships[p[0]] = {'p2p': [], 'c2p': [], 'p2c': []}
-        link_rev_map[p[0]] = {}
-        link_map[p[0]] = {}
-        link_rev_map[p[0]] = {}
-    links[p[0]].append(p[1])
-    link_map[p[0]][p[1]] = len(links[p[0]])
-    link_rev_map[p[0]][link_map[p[0]][p[1]]] = p[1] 
-    relationship[p[0]][p[1]] = p[2]
-    relationships[p[0]][p[2]].append(p[1])
-obj = {}
-obj['AdjacencyMatrix'] = {}
-for k in sorted(as_rev_map.keys()):
-    v = k
-    k = as_rev_map[v]
-    adj = map(lambda l: as_map[l], links[k])
+from optparse import OptionParser
+import topology
+
+
+def adjacency(topo, v):
+    adj = topo.links(v).tolist()
     adj.append(v)
     adj.sort()
-    obj['AdjacencyMatrix'][str(v)] = adj
-obj['PortToNodeMap'] = {}
-obj['NodeToPortMap'] = {}
-for k in sorted(as_rev_map.keys()):
-    v = k
-    k = as_rev_map[v]
-    obj['PortToNodeMap'][str(v)] = [v]
-    obj['NodeToPortMap'][str(v)] = {str(v):0}
+    return adj
+
+
+def port_to_node(topo, v):
+    return [v] + topo.links(v).tolist()
+
+
+def node_to_port(topo, v):
+    ports = {str(v): 0}
     port = 1
-    for link in links[k]:
-        obj['PortToNodeMap'][str(v)].append(as_map[link])
-        obj['NodeToPortMap'][str(v)][str(as_map[link])] = port
+    for link in topo.links(v):
+        ports[str(link)] = port
         port += 1
-        #print "%d %d"%(v, as_map[link])
-obj['ExportTables'] = {}
+    return ports
+
+
 # Link 0 is always the link to self
-for k in sorted(as_rev_map.keys()):
-    v = k
-    k = as_rev_map[v]
-    # Row 0
-    obj['ExportTables'][str(v)] = [[1]]
-    for i in links[k]:
-        obj['ExportTables'][str(v)][0].append(0)
-    #other rows
-    for i in links[k]:
-        export = [1]
-        rel = relationship[k][i]
-        for j in links[k]:
-            if j == i:
-                export.append(0)
-            elif rel == 'p2p':
-                if relationship[k][j] == 'p2c':
-                    export.append(1)
-                else:
-                    export.append(0)
-            elif rel == 'p2c':
-                export.append(1)
-            elif rel == 'c2p':
-                if relationship[k][j] == 'p2c':
-                    export.append(1)
-                else:
-                    export.append(0)
-        obj['ExportTables'][str(v)].append(export)
-obj['IndicesLink'] = {}
-obj['IndicesNode'] = {}
+def export_table(topo, v):
+    return topology.export_table(topo.relationships(v), topo.links(v))
+
+
+# Compact form of the export table: the class of each port. Together with
+# ExportRules and PortToNodeMap this determines the dense table.
+def export_classes(topo, v):
+    return topo.relationships(v).tolist()
+
+
+# Turn a parsed compact document back into one with dense ExportTables
+def expand_export_tables(obj):
+    tables = {}
+    for (v, classes) in obj['ExportClasses'].iteritems():
+        tables[v] = topology.export_table(classes, obj['PortToNodeMap'][v][1:])
+    obj['ExportTables'] = tables
+    return obj
+
+
 #ordering clients then peers then providers
-for k in sorted(as_rev_map.keys()):
-    v = k
-    k = as_rev_map[v]
+def indices_link(topo, v):
     print >>sys.stderr, str(v)
-    obj['IndicesNode'][str(v)] = [v]
-    obj['IndicesLink'][str(v)] = [0]
-    for n in relationships[k]['p2c']:
-        obj['IndicesNode'][str(v)].append(as_map[n])
-        obj['IndicesLink'][str(v)].append(link_map[k][n])
-    for n in relationships[k]['p2p']:
-        obj['IndicesNode'][str(v)].append(as_map[n])
-        obj['IndicesLink'][str(v)].append(link_map[k][n])
-    for n in relationships[k]['c2p']:
-        obj['IndicesNode'][str(v)].append(as_map[n])
-        obj['IndicesLink'][str(v)].append(link_map[k][n])
+    return [0] + topo.ports_by_class(v).tolist()
 
 
+def indices_node(topo, v):
+    links = topo.links(v).tolist()
+    return [v] + [links[p - 1] for p in topo.ports_by_class(v).tolist()]
 
 
-import json
-print json.dumps(obj)
+SECTIONS = [
+    ('AdjacencyMatrix', adjacency),
+    ('PortToNodeMap', port_to_node),
+    ('NodeToPortMap', node_to_port),
+    ('ExportTables', export_table),
+    ('IndicesLink', indices_link),
+    ('IndicesNode', indices_node),
+]
+COMPACT_SECTIONS = [
+    ('AdjacencyMatrix', adjacency),
+    ('PortToNodeMap', port_to_node),
+    ('NodeToPortMap', node_to_port),
+    ('ExportClasses', export_classes),
+    ('IndicesLink', indices_link),
+    ('IndicesNode', indices_node),
+]
+
+
+# Build the whole object and serialize it in one go
+def write_in_memory(topo, out, sections, extra):
+    obj = dict(extra)
+    for (name, section) in sections:
+        obj[name] = {}
+        for v in topo.nodes():
+            obj[name][str(v)] = section(topo, v)
+    out.write(json.dumps(obj))
+    out.write('\n')
+
+
+# Write the same object one node at a time, so only a single node's entry
+# is ever held in memory. Sections and nodes come out in a fixed order,
+# otherwise the text matches json.dumps.
+def write_streaming(topo, out, sections, extra):
+    out.write('{')
+    for (name, value) in sorted(extra.items()):
+        out.write('"%s": %s, ' % (name, json.dumps(value)))
+    for (s, (name, section)) in enumerate(sections):
+        if s > 0:
+            out.write(', ')
+        out.write('"%s": {' % name)
+        first = True
+        for v in topo.nodes():
+            if not first:
+                out.write(', ')
+            first = False
+            out.write('"%d": ' % v)
+            out.write(json.dumps(section(topo, v)))
+        out.write('}')
+    out.write('}\n')
+
+
+def parse_args():
+    parser = OptionParser(usage="adjacency_matrix.py [options] topology")
+    parser.add_option("-o", "--output", default="",
+        help="File to write the JSON to (default: stdout)")
+    parser.add_option("--in-memory", action="store_true", default=False,
+        help="Build the whole object before writing it instead of " +
+             "streaming it node by node")
+    parser.add_option("--no-cache", action="store_true", default=False,
+        help="Parse the topology file even if a cached copy exists")
+    parser.add_option("--compact-export", action="store_true", default=False,
+        help="Write per-port ExportClasses and ExportRules instead of dense " +
+             "ExportTables (expand with expand_export_tables)")
+    (opts, args) = parser.parse_args()
+    if len(args) < 1:
+        parser.print_help()
+        sys.exit(1)
+    return (opts, args[0])
+
+
+def main():
+    (opts, topo_file) = parse_args()
+    topo = topology.load(topo_file, cache=not opts.no_cache)
+    if opts.output != "":
+        out = open(opts.output, 'w', 1 << 20)
+    else:
+        out = os.fdopen(sys.stdout.fileno(), 'w', 1 << 20)
+    if opts.compact_export:
+        sections = COMPACT_SECTIONS
+        extra = {'ExportRules': topology.EXPORT_RULES}
+    else:
+        sections = SECTIONS
+        extra = {}
+    if opts.in_memory:
+        write_in_memory(topo, out, sections, extra)
+    else:
+        write_streaming(topo, out, sections, extra)
+    out.close()
+
+
+if __name__ == "__main__":
+    main()
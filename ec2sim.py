@@ -0,0 +1,365 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Local stand-in for EC2 and SSH, for benchmarking launch_smpc.py offline.
+
+SimConnection answers the subset of boto's EC2Connection API that
+launch_smpc.py uses (security groups, images, instances, spot requests and
+tags) from memory, and also takes the place of the hosts themselves: it has
+the probe, ssh and copy methods of launch_smpc.SSHHosts, and launch_smpc.py's
+connect returns it for both under --backend=sim.
+
+Everything runs in real time so the launch pipeline's own waits and
+backoffs are measured as they are:
+
+  * instances stay pending for about boot_time seconds, and their SSH
+    daemon comes up about boot_time / 2 seconds after they are running;
+  * a spot request is fulfilled after about spot_delay seconds, or never
+    for the share of requests beyond spot_fill;
+  * every command or copy takes about command_time seconds and fails with
+    probability failure_rate;
+  * ``git ls-remote`` answers with revision, which stays the same for the
+    life of the connection unless changed, so setup stamps can be tested.
+
+"About" means uniformly within +/-50%. The simulated account only lives as
+long as the process, so only launch makes sense against it.
+"""
+
+from __future__ import with_statement
+
+import copy
+import random
+import subprocess
+import threading
+import time
+import boto.exception
+
+
+def _not_found(code, ids):
+  e = boto.exception.EC2ResponseError(400, "Bad Request")
+  e.error_code = code
+  e.error_message = "The ID(s) %s do not exist" % ", ".join(ids)
+  return e
+
+
+class SimZone(object):
+  def __init__(self, name):
+    self.name = name
+
+
+class SimRule(object):
+  def __init__(self, ip_protocol, from_port, to_port, grants):
+    self.ip_protocol = ip_protocol
+    self.from_port = from_port
+    self.to_port = to_port
+    self.grants = grants
+
+
+class SimGroup(object):
+  def __init__(self, connection, name, description):
+    self.connection = connection
+    self.name = name
+    self.id = connection._new_id("sg")
+    self.description = description
+    self.rules = []
+
+  def authorize(self, ip_protocol=None, from_port=None, to_port=None,
+                cidr_ip=None, src_group=None):
+    grant = src_group if src_group != None else cidr_ip
+    self.rules.append(SimRule(ip_protocol, from_port, to_port, [grant]))
+    return True
+
+  def revoke(self, ip_protocol=None, from_port=None, to_port=None,
+             cidr_ip=None, src_group=None):
+    grant = src_group if src_group != None else cidr_ip
+    self.rules = [r for r in self.rules
+                  if (r.ip_protocol, r.from_port, r.to_port, r.grants) !=
+                     (ip_protocol, from_port, to_port, [grant])]
+    return True
+
+
+# Instances handed out by describe calls are copies, as with boto; actions
+# on them go to the connection's own record.
+class SimInstance(object):
+  def __init__(self, connection, number, placement, instance_type):
+    self.connection = connection
+    self.id = connection._new_id("i")
+    self.state = "pending"
+    self.tags = {}
+    self.placement = placement
+    self.instance_type = instance_type
+    self.private_ip_address = "10.%d.%d.%d" % (
+        (number >> 16) & 255, (number >> 8) & 255, number & 255)
+    self.public_dns_name = "ec2-sim-%d.compute.local" % number
+
+  def _update(self, other):
+    self.__dict__.update(other.__dict__)
+
+  def update(self):
+    self._update(self.connection._instance(self.id))
+    return self.state
+
+  def start(self):
+    self.connection._set_state(self.id, "start")
+
+  def stop(self):
+    self.connection._set_state(self.id, "stop")
+
+  def terminate(self):
+    self.connection._set_state(self.id, "terminate")
+
+
+class SimReservation(object):
+  def __init__(self, id, instances, groups):
+    self.id = id
+    self.instances = instances
+    self.groups = groups
+
+
+class SimImage(object):
+  def __init__(self, connection, id):
+    self.connection = connection
+    self.id = id
+
+  def run(self, min_count=1, max_count=1, key_name=None, security_groups=None,
+          instance_type=None, placement=None, block_device_map=None):
+    return self.connection._launch(max_count, security_groups, instance_type,
+                                   placement)
+
+
+class SimSpotRequest(object):
+  def __init__(self, connection, placement, groups, instance_type, fill_at):
+    self.id = connection._new_id("sir")
+    self.state = "open"
+    self.instance_id = None
+    self.placement = placement
+    self.groups = groups
+    self.instance_type = instance_type
+    self.fill_at = fill_at
+
+
+class SimConnection(object):
+  def __init__(self, boot_time=20, spot_delay=30, spot_fill=1.0,
+               command_time=1.0, failure_rate=0.0, seed=None,
+               zones=("sim-1a", "sim-1b"), revision="0" * 40):
+    self.boot_time = boot_time
+    self.spot_delay = spot_delay
+    self.spot_fill = spot_fill
+    self.command_time = command_time
+    self.failure_rate = failure_rate
+    self.revision = revision
+    self.zones = [SimZone(z) for z in zones]
+    self.random = random.Random(seed)
+    self.lock = threading.RLock()
+    self.counter = 0
+    self.groups = {}
+    self.reservations = []
+    self.instances = {}
+    self.hosts = {}
+    self.spot_requests = {}
+    # Per-instance times at which it finishes booting or shutting down
+    self.timers = {}
+
+  def _new_id(self, prefix):
+    with self.lock:
+      self.counter += 1
+      return "%s-%08x" % (prefix, self.counter)
+
+  def _about(self, seconds):
+    with self.lock:
+      return seconds * self.random.uniform(0.5, 1.5)
+
+  def _fails(self):
+    with self.lock:
+      return self.random.random() < self.failure_rate
+
+  # Move instances along their lifecycle to where they are by now
+  def _tick(self):
+    now = time.time()
+    with self.lock:
+      for req in self.spot_requests.values():
+        if req.state == "open" and req.fill_at != None and now >= req.fill_at:
+          res = self._launch(1, req.groups, req.instance_type, req.placement)
+          req.state = "active"
+          req.instance_id = res.instances[0].id
+      for (id, (state, at)) in self.timers.items():
+        if now >= at:
+          inst = self.instances[id]
+          inst.state = state
+          if state == "running":
+            inst._sshd_at = at + self._about(self.boot_time / 2.0)
+          del self.timers[id]
+
+  def _launch(self, count, groups, instance_type, placement):
+    with self.lock:
+      instances = []
+      for i in xrange(count):
+        self.counter += 1
+        inst = SimInstance(self, self.counter, placement, instance_type)
+        self.instances[inst.id] = inst
+        self.hosts[inst.public_dns_name] = inst.id
+        self.hosts[inst.private_ip_address] = inst.id
+        self.timers[inst.id] = ("running", time.time() + self._about(self.boot_time))
+        instances.append(inst)
+      res = SimReservation(self._new_id("r"), instances,
+                           [self.groups.get(g, g) for g in groups])
+      self.reservations.append(res)
+      return res
+
+  def _instance(self, id):
+    self._tick()
+    with self.lock:
+      if id not in self.instances:
+        raise _not_found("InvalidInstanceID.NotFound", [id])
+      return copy.copy(self.instances[id])
+
+  def _set_state(self, id, action):
+    self._tick()
+    with self.lock:
+      inst = self.instances[id]
+      if inst.state in ("shutting-down", "terminated"):
+        return
+      if action == "terminate":
+        (inst.state, final) = ("shutting-down", "terminated")
+      elif action == "stop" and inst.state in ("pending", "running"):
+        (inst.state, final) = ("stopping", "stopped")
+      elif action == "start" and inst.state == "stopped":
+        (inst.state, final) = ("pending", "running")
+      else:
+        return
+      delay = self.boot_time if final == "running" else self.boot_time / 4.0
+      self.timers[id] = (final, time.time() + self._about(delay))
+
+
+  # EC2 API
+
+  def get_all_zones(self):
+    return list(self.zones)
+
+  def get_all_images(self, image_ids=None):
+    return [SimImage(self, id) for id in (image_ids or ["ami-sim"])]
+
+  def get_all_security_groups(self):
+    with self.lock:
+      return self.groups.values()
+
+  def create_security_group(self, name, description):
+    with self.lock:
+      self.groups[name] = SimGroup(self, name, description)
+      return self.groups[name]
+
+  def delete_security_group(self, name):
+    with self.lock:
+      in_use = [r for r in self.reservations
+                if name in [g.name for g in r.groups] and
+                any(self.instances[i.id].state != "terminated" for i in r.instances)]
+      if in_use != []:
+        e = boto.exception.EC2ResponseError(400, "Bad Request")
+        e.error_code = "DependencyViolation"
+        raise e
+      del self.groups[name]
+    return True
+
+  def get_all_instances(self, instance_ids=None, filters=None):
+    self._tick()
+    with self.lock:
+      if instance_ids != None:
+        missing = [id for id in instance_ids if id not in self.instances]
+        if missing != []:
+          raise _not_found("InvalidInstanceID.NotFound", missing)
+      wanted = dict((k, v if isinstance(v, list) else [v])
+                    for (k, v) in (filters or {}).items())
+      for k in wanted:
+        if k not in ("instance.group-name", "instance-state-name"):
+          raise ValueError("Filter %s is not simulated" % k)
+      result = []
+      for res in self.reservations:
+        groups = [g.name for g in res.groups]
+        if "instance.group-name" in wanted and \
+            not set(groups) & set(wanted["instance.group-name"]):
+          continue
+        instances = [copy.copy(self.instances[i.id]) for i in res.instances
+                     if instance_ids == None or i.id in instance_ids]
+        if "instance-state-name" in wanted:
+          instances = [i for i in instances
+                       if i.state in wanted["instance-state-name"]]
+        if instances != []:
+          result.append(SimReservation(res.id, instances, res.groups))
+      return result
+
+  def terminate_instances(self, instance_ids):
+    for id in instance_ids:
+      self._set_state(id, "terminate")
+
+  def create_tags(self, resource_ids, tags):
+    with self.lock:
+      for id in resource_ids:
+        self.instances[id].tags.update(tags)
+    return True
+
+  def request_spot_instances(self, price, image_id, count=1, launch_group=None,
+                             placement=None, key_name=None,
+                             security_groups=None, instance_type=None,
+                             block_device_map=None):
+    with self.lock:
+      reqs = []
+      for i in xrange(count):
+        fill_at = None
+        if self.random.random() < self.spot_fill:
+          fill_at = time.time() + self._about(self.spot_delay)
+        req = SimSpotRequest(self, placement, security_groups, instance_type,
+                             fill_at)
+        self.spot_requests[req.id] = req
+        reqs.append(req)
+      return [copy.copy(r) for r in reqs]
+
+  def get_all_spot_instance_requests(self, request_ids=None):
+    self._tick()
+    with self.lock:
+      ids = request_ids if request_ids != None else self.spot_requests.keys()
+      missing = [id for id in ids if id not in self.spot_requests]
+      if missing != []:
+        raise _not_found("InvalidSpotInstanceRequestID.NotFound", missing)
+      return [copy.copy(self.spot_requests[id]) for id in ids]
+
+  def cancel_spot_instance_requests(self, request_ids):
+    self._tick()
+    with self.lock:
+      for id in request_ids:
+        self.spot_requests[id].state = "cancelled"
+    return True
+
+  # Hosts
+
+  # Whether host accepts SSH connections
+  def probe(self, host):
+    self._tick()
+    with self.lock:
+      inst = self.instances.get(self.hosts.get(host))
+      return inst != None and inst.state == "running" and \
+          time.time() >= inst._sshd_at
+
+  # Run a command on host, returning its output; raises
+  # subprocess.CalledProcessError the way a failed ssh does. A fan-out
+  # round script (see launch_smpc.fanout_script) runs its copies at once
+  # and reports each one that succeeded.
+  def ssh(self, host, command, stdin_data=None, output=False):
+    self._work(host, command)
+    if "git ls-remote" in command:
+      return "%s\tHEAD\n" % self.revision
+    sends = [l.split() for l in (stdin_data or "").splitlines()
+             if l.startswith("send ")]
+    if sends == []:
+      return ""
+    time.sleep(self._about(self.command_time))
+    return "".join("ok %s\n" % p[2] for p in sends
+                   if self.probe(p[2]) and not self._fails())
+
+  # Copy files to host
+  def copy(self, host, command):
+    self._work(host, command)
+
+  def _work(self, host, command):
+    time.sleep(self._about(self.command_time))
+    if not self.probe(host) or self._fails():
+      raise subprocess.CalledProcessError(255, command)
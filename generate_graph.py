@@ -1,30 +1,205 @@
-import sys
+import hashlib
+import itertools
+import os
 import random
-if len(sys.argv) < 2:
-    print >>sys.stderr, "Usage %s nodes tier_links peer_links"%(sys.argv[0])
-    sys.exit(1)
-nnodes = eval(sys.argv[1])
-tier_links = eval(sys.argv[2])
-peer_links = eval(sys.argv[3])
-tier_nodes = {}
-node_so_far = 0
-for i in xrange(0, len(nnodes)):
-    tier_nodes[i] = map(lambda k: k + node_so_far, range(0, nnodes[i]))
-    node_so_far = tier_nodes[i][-1] + 1
-for i in xrange(0, len(tier_links)):
-    for node in tier_nodes[i]:
-        other_nodes = random.sample(tier_nodes[i + 1], tier_links[i])
-        for on in other_nodes:
-            print "%d %d p2c"%(node, on)
-            print "%d %d c2p"%(on, node)
-peered = []
-for i in xrange(0, len(peer_links)):
-    for node in tier_nodes[i]:
-        other_nodes = random.sample(filter(lambda k: k != node, tier_nodes[i]), peer_links[i])
-        for on in other_nodes:
-            if (node, on) not in peered:
-                print "%d %d p2p"%(node, on)
-                print "%d %d p2p"%(on, node)
-                peered.append((node, on))
-                peered.append((on, node))
+import struct
+import sys
+from multiprocessing import Pool
+from optparse import OptionParser
+import numpy
+
+# Nodes per shard. Every shard draws from its own generator seeded from the
+# master seed, so the output only depends on the seed, never on how shards
+# are spread over workers.
+SHARD = 1 << 16
+
+
+def shard_rng(seed, kind, tier, shard):
+    h = hashlib.sha1("%d:%s:%d:%d" % (seed, kind, tier, shard)).digest()
+    return numpy.random.RandomState(struct.unpack("<I", h[:4])[0])
+
+
+# Pick k distinct values in [0, m) for each of n rows. Sample with
+# replacement and redraw the rows that came out with duplicates, which is
+# cheap as long as k is small next to m; otherwise take a prefix of a
+# random permutation per row.
+def sample_rows(rng, n, m, k):
+    if k > m:
+        raise ValueError("cannot pick %d distinct nodes out of %d" % (k, m))
+    if k == 0:
+        return numpy.zeros((n, 0), dtype=numpy.int64)
+    if 2 * k > m:
+        return rng.rand(n, m).argsort(axis=1)[:, :k]
+    rows = rng.randint(0, m, size=(n, k))
+    while True:
+        s = numpy.sort(rows, axis=1)
+        dup = numpy.nonzero((s[:, 1:] == s[:, :-1]).any(axis=1))[0]
+        if len(dup) == 0:
+            return rows
+        rows[dup] = rng.randint(0, m, size=(len(dup), k))
+
+
+# Format each (a, b) pair as two directed links a->b rel and b->a rev_rel
+def format_links(a, b, rel, rev_rel):
+    if len(a) == 0:
+        return ""
+    flat = numpy.column_stack((a, b, b, a)).ravel().tolist()
+    return ("%%d %%d %s\n%%d %%d %s\n" % (rel, rev_rel) * len(a)) % tuple(flat)
+
+
+def tier_shard(seed, tiers, i, k, shard):
+    (first, count) = tiers[i]
+    (next_first, next_count) = tiers[i + 1]
+    start = shard * SHARD
+    n = min(SHARD, count - start)
+    others = sample_rows(shard_rng(seed, "tier", i, shard), n, next_count, k)
+    nodes = numpy.repeat(numpy.arange(first + start, first + start + n), k)
+    return format_links(nodes, (others + next_first).ravel(), 'p2c', 'c2p')
+
+
+# Peers picked by the nodes of one shard, as indices within the tier
+def peer_samples(seed, tiers, i, k, shard):
+    count = tiers[i][1]
+    start = shard * SHARD
+    n = min(SHARD, count - start)
+    # Sample among the other count - 1 nodes by skipping over ourselves
+    others = sample_rows(shard_rng(seed, "peer", i, shard), n, count - 1, k)
+    others += (others >= numpy.arange(start, start + n)[:, None])
+    return others
+
+
+# Peerings the nodes of one shard picked towards later nodes, as keys
+# a * count + b (indices within the tier), bucketed by the shard of b
+def forward_keys(seed, tiers, i, k, shard):
+    count = tiers[i][1]
+    samples = peer_samples(seed, tiers, i, k, shard)
+    start = shard * SHARD
+    a = numpy.repeat(numpy.arange(start, start + len(samples)), k)
+    b = samples.ravel()
+    fwd = a < b
+    (a, b) = (a[fwd], b[fwd])
+    owner = b // SHARD
+    return dict((o, a[owner == o] * count + b[owner == o])
+                for o in numpy.unique(owner).tolist())
+
+
+# A peering a-b is written once, by whichever of a and b comes first among
+# the nodes that picked the other. picked holds the keys of the forward
+# picks into this shard (see forward_keys), so a node's pick of an earlier
+# node is dropped when that node picked it too, and the result matches a
+# single global pass whatever the shard boundaries.
+def peer_shard(seed, tiers, i, k, shard, picked):
+    (first, count) = tiers[i]
+    samples = peer_samples(seed, tiers, i, k, shard)
+    start = shard * SHARD
+    a = numpy.repeat(numpy.arange(start, start + len(samples)), k)
+    b = samples.ravel()
+    keep = a < b
+    back = numpy.nonzero(~keep)[0]
+    keep[back] = ~numpy.in1d(b[back] * count + a[back], picked)
+    return format_links(a[keep] + first, b[keep] + first, 'p2p', 'p2p')
+
+
+# Run one shard, either returning its text or writing it to its own file
+def run_shard(task):
+    (fn, args, path) = task
+    text = fn(*args)
+    if path is None:
+        return text
+    with open(path, 'w') as f:
+        f.write(text)
+    return ""
+
+
+def num_shards(tiers, i):
+    return (tiers[i][1] + SHARD - 1) // SHARD
+
+
+# Sample every peer shard once and gather its forward picks by the shard
+# they point into: picked[i][shard] is what peer_shard needs for that shard
+def peer_keys(imap, seed, tiers, peer_k):
+    tasks = [(forward_keys, (seed, tiers, i, peer_k[i], shard), None)
+             for i in xrange(0, len(peer_k)) for shard in xrange(0, num_shards(tiers, i))]
+    picked = [[[] for shard in xrange(0, num_shards(tiers, i))]
+              for i in xrange(0, len(peer_k))]
+    for (task, keys) in itertools.izip(tasks, imap(run_shard, tasks)):
+        i = task[1][2]
+        for (shard, k) in keys.iteritems():
+            picked[i][shard].append(k)
+    return [[numpy.concatenate(p) if p else numpy.zeros(0, dtype=numpy.int64)
+             for p in tier] for tier in picked]
+
+
+def shard_tasks(seed, tiers, tier_k, peer_k, picked, shard_dir):
+    tasks = []
+    for i in xrange(0, len(tier_k)):
+        for shard in xrange(0, num_shards(tiers, i)):
+            tasks.append((tier_shard, (seed, tiers, i, tier_k[i], shard)))
+    for i in xrange(0, len(peer_k)):
+        for shard in xrange(0, num_shards(tiers, i)):
+            tasks.append((peer_shard, (seed, tiers, i, peer_k[i], shard, picked[i][shard])))
+    if shard_dir == "":
+        return [(fn, args, None) for (fn, args) in tasks]
+    return [(fn, args, os.path.join(shard_dir, "part-%05d" % n))
+            for (n, (fn, args)) in enumerate(tasks)]
+
+
+def parse_args():
+    parser = OptionParser(usage="generate_graph.py [options] nodes tier_links peer_links")
+    parser.add_option("--seed", type="int", default=None,
+        help="Seed for the random generator (default: random)")
+    parser.add_option("-o", "--output", default="",
+        help="File to write the topology to (default: stdout)")
+    parser.add_option("-j", "--workers", type="int", default=1,
+        help="Number of worker processes (default: 1)")
+    parser.add_option("--shard-dir", default="",
+        help="Write one file per shard into this directory instead of a " +
+             "single topology; topology.load reads the directory directly")
+    (opts, args) = parser.parse_args()
+    if len(args) < 3:
+        parser.print_help()
+        sys.exit(1)
+    return (opts, eval(args[0]), eval(args[1]), eval(args[2]))
+
+
+def main():
+    (opts, nnodes, tier_k, peer_k) = parse_args()
+    # (first node, node count) for every tier
+    tiers = []
+    node_so_far = 0
+    for n in nnodes:
+        tiers.append((node_so_far, n))
+        node_so_far += n
+    if opts.seed is None:
+        opts.seed = random.SystemRandom().randint(0, 2 ** 31 - 1)
+        print >>sys.stderr, "Using seed %d" % opts.seed
+    if opts.shard_dir != "":
+        if not os.path.isdir(opts.shard_dir):
+            os.makedirs(opts.shard_dir)
+        # Shards left from an earlier run would be read along with ours
+        for name in os.listdir(opts.shard_dir):
+            if name.startswith("part-"):
+                os.remove(os.path.join(opts.shard_dir, name))
+    if opts.workers > 1:
+        pool = Pool(opts.workers)
+        imap = pool.imap
+    else:
+        pool = None
+        imap = itertools.imap
+    picked = peer_keys(imap, opts.seed, tiers, peer_k)
+    tasks = shard_tasks(opts.seed, tiers, tier_k, peer_k, picked, opts.shard_dir)
+    results = imap(run_shard, tasks)
+    if opts.output != "":
+        out = open(opts.output, 'w', 1 << 20)
+    else:
+        out = sys.stdout
+    for text in results:
+        out.write(text)
+    out.close()
+    if pool is not None:
+        pool.close()
+        pool.join()
+
 
+if __name__ == "__main__":
+    main()
@@ -1,57 +1,82 @@
+import os
 import sys
-if len(sys.argv) < 3:
-    print >>sys.stderr, "adjacency_matrix.py topology result_file"
-    sys.exit(1)
-f = open(sys.argv[1])
-as_assigned = 1
-as_map = {}
-as_rev_map = {}
-links = {}
-link_map = {}
-link_rev_map = {}
-relationship = {}
-relationships = {}
-for l in f:
-    p = l.strip().split()
-    if p[0] not in as_map:
-        as_map[p[0]] = as_assigned
-        as_rev_map[as_assigned] = p[0]
-        as_assigned += 1
-    if p[1] not in as_map:
-        as_map[p[1]] = as_assigned
-        as_rev_map[as_assigned] = p[1]
-        as_assigned += 1
-    if p[0] not in links:
-        links[p[0]] = []
-        relationship[p[0]] = {}
-        relationships[p[0]] = {'p2p': [], 'c2p': [], 'p2c': []}
-        link_rev_map[p[0]] = {}
-        link_map[p[0]] = {}
-        link_rev_map[p[0]] = {}
-    links[p[0]].append(p[1])
-    link_map[p[0]][p[1]] = len(links[p[0]])
-    link_rev_map[p[0]][link_map[p[0]][p[1]]] = p[1] 
-    relationship[p[0]][p[1]] = p[2]
-    relationships[p[0]][p[2]].append(p[1])
-
-#for i in links[as_rev_map[190]]:
-#    print "%s(%s) %s(%s)"%(as_map[as_rev_map[190]], as_rev_map[as_map[as_rev_map[190]]], i, as_map[i])
-f.close()
-f = open(sys.argv[2])
-# Transform line 1
-l = f.readline()
-p = l.split()
-def transform(s):
+from optparse import OptionParser
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import topology
+import analyze
+
+# Translated lines written per batch
+BATCH = 4096
+
+
+def transform(as_rev_map, s):
     if s.isdigit():
-        return str(as_rev_map[int(s)])
+        return as_rev_map[int(s)]
     else:
         return s
-np = map(transform, p)
-print ' '.join(np)
-# Do the rest
-for l in f:
-    p = l.split()
-    print "%s "% transform(p[0]),
-    print "%s "%transform(p[1]),
-    print ' '.join(p[2:])
-    
+
+
+# Map the internal node ids of a result file back to AS numbers, yielding
+# the translated lines. Rows keep the spacing of the old print statements.
+def translate(as_rev_map, f):
+    lines = iter(f)
+    # Transform line 1
+    p = next(lines).split()
+    yield ' '.join([transform(as_rev_map, s) for s in p]) + '\n'
+    # Do the rest
+    for l in lines:
+        p = l.split()
+        yield "%s  %s  %s\n" % (transform(as_rev_map, p[0]), transform(as_rev_map, p[1]),
+                                ' '.join(p[2:]))
+
+
+def write_lines(out, lines):
+    batch = []
+    for l in lines:
+        batch.append(l)
+        if len(batch) == BATCH:
+            out.write(''.join(batch))
+            batch = []
+    out.write(''.join(batch))
+
+
+def parse_args():
+    parser = OptionParser(usage="%prog [options] topology result_file\n\n" +
+        "result_file and the output may be gzip (.gz) or zstd (.zst) compressed")
+    parser.add_option("-o", "--output", default="-",
+        help="File to write the translated results to (default: stdout)")
+    parser.add_option("--total", metavar="FILE",
+        help="Instead of writing the translation, feed it to analyze.py " +
+             "and write the class fractions here")
+    parser.add_option("--by-link", metavar="FILE",
+        help="As --total, writing class counts per link")
+    parser.add_option("--by-dest", metavar="FILE",
+        help="As --total, writing class counts per destination")
+    parser.add_option("--routes", action="store_true", default=False,
+        help="Accept routes.py output, whose classes are not SMPC results")
+    (opts, args) = parser.parse_args()
+    if len(args) < 2:
+        parser.print_help()
+        sys.exit(1)
+    return (opts, args[0], args[1])
+
+
+def main():
+    (opts, topo_file, result_file) = parse_args()
+    topo = topology.load(topo_file)
+    f = analyze.open_input(result_file)
+    lines = translate(topo.names, f)
+    if (opts.total, opts.by_link, opts.by_dest) != (None, None, None):
+        outs = [analyze.open_report(opts.total), analyze.open_report(opts.by_link),
+                analyze.open_report(opts.by_dest)]
+        analyze.analyze(lines, outs[0], outs[1], outs[2], opts.routes)
+        analyze.close_reports(outs)
+    else:
+        out = analyze.open_report(opts.output)
+        write_lines(out, lines)
+        analyze.close_reports([out])
+    f.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,277 @@
+import os
+import subprocess
+import sys
+from cStringIO import StringIO
+from multiprocessing import Pool
+from optparse import OptionParser
+
+CLASSES = ['0', '1', '2', '3', '4']
+VALID = frozenset(CLASSES)
+# First header token of routes.py output, whose classes mean something else
+# than the SMPC ones
+ROUTES_TAG = 'routes'
+# Compressed files are piped through these command line tools, which keeps
+# (de)compression off the process doing the counting
+COMPRESSORS = {'.gz': 'gzip', '.zst': 'zstd'}
+# Classes (rows x destinations) gathered before counting them column-wise;
+# wide files are counted a few rows at a time
+BATCH_CELLS = 1 << 20
+
+
+def write_totals(out, totals, ntokens):
+    for k in xrange(0, len(CLASSES)):
+        print >>out, "%s %f" % (CLASSES[k], float(totals[k]) / float(ntokens))
+
+
+def write_link(out, src, dst, counts):
+    print >>out, "%s %s %f %f %f %f" % (src, dst, float(counts[1]), float(counts[2]), float(counts[3]), float(counts[4]))
+
+
+def write_dests(out, dests, dest_counts):
+    for idx in xrange(0, len(dests)):
+        print >>out, "%s %f %f %f %f" % (dests[idx], float(dest_counts[1][idx]), float(dest_counts[2][idx]), float(dest_counts[3][idx]), float(dest_counts[4][idx]))
+
+
+def count_columns(dest_counts, rows):
+    for (idx, column) in enumerate(zip(*rows)):
+        for k in xrange(0, len(CLASSES)):
+            dest_counts[k][idx] += column.count(CLASSES[k])
+
+
+# Destinations named by the header line of a result file. routes.py output
+# raises ValueError unless routes is set.
+def read_header(line, routes=False):
+    p = line.split()
+    if p[:1] == [ROUTES_TAG]:
+        if not routes:
+            raise ValueError("this is routes.py output, its classes are not SMPC results " +
+                             "(use analyze.py --routes)")
+        p = p[1:]
+    return p[2:]
+
+
+# Error for the row of link "src dst" with nclasses classes: the wrong
+# number of them, or else one that is not in CLASSES
+def bad_row(link, nclasses, ndests):
+    if nclasses != ndests:
+        return ValueError("row %s has %d classes, expected %d" % (link, nclasses, ndests))
+    return ValueError("row %s has a class outside %s-%s" % (link, CLASSES[0], CLASSES[-1]))
+
+
+# Count the classes of result rows. Per-link lines are written to link_out
+# as rows are read, totals and per-destination counts are returned. A row
+# with the wrong number of classes, or a class that is not one of CLASSES,
+# raises ValueError.
+def count_rows(lines, ndests, total=False, link_out=None, dest=False):
+    totals = [0] * len(CLASSES)
+    ntokens = 0
+    dest_counts = [[0] * (ndests if dest else 0) for k in CLASSES]
+    batch = max(1, BATCH_CELLS // max(ndests, 1))
+    rows = []
+    for l in lines:
+        p = l.split()
+        if not p:
+            continue
+        classes = p[2:]
+        if len(classes) != ndests:
+            raise bad_row(' '.join(p[:2]), len(classes), ndests)
+        if total or link_out is not None:
+            counts = [classes.count(k) for k in CLASSES]
+            if sum(counts) != ndests:
+                raise bad_row(' '.join(p[:2]), len(classes), ndests)
+            if link_out is not None:
+                write_link(link_out, p[0], p[1], counts)
+            if total:
+                ntokens += len(classes)
+                for k in xrange(0, len(CLASSES)):
+                    totals[k] += counts[k]
+        elif not VALID.issuperset(classes):
+            raise bad_row(' '.join(p[:2]), len(classes), ndests)
+        if dest:
+            rows.append(classes)
+            if len(rows) == batch:
+                count_columns(dest_counts, rows)
+                rows = []
+    if dest:
+        count_columns(dest_counts, rows)
+    return (totals, ntokens, dest_counts)
+
+
+# Produce any of the global (process.py), per-link (analyze_by_link.py) and
+# per-destination (analyze_by_dest.py) reports for a result file in a
+# single pass. Each report goes to its own file handle, None skips it.
+# routes.py output is only accepted with routes set.
+def analyze(f, total_out=None, link_out=None, dest_out=None, routes=False):
+    # f can be any iterable of lines; the first only names the destinations
+    lines = iter(f)
+    dests = read_header(next(lines), routes)
+    (totals, ntokens, dest_counts) = count_rows(lines, len(dests),
+        total_out is not None, link_out, dest_out is not None)
+    if dest_out is not None:
+        write_dests(dest_out, dests, dest_counts)
+    if total_out is not None:
+        write_totals(total_out, totals, ntokens)
+
+
+# Split the rows of a result file into newline-aligned byte ranges of
+# roughly RANGE bytes, at least per_job ranges for each job
+RANGE = 64 << 20
+
+
+def byte_ranges(f, jobs, per_job=4):
+    f.seek(0, os.SEEK_END)
+    size = f.tell()
+    f.seek(0)
+    f.readline()
+    start = f.tell()
+    count = max(jobs * per_job, (size - start) // RANGE, 1)
+    step = max((size - start) // count, 1)
+    ranges = []
+    while start < size:
+        f.seek(min(start + step, size))
+        # move up to the start of the next line
+        if f.tell() < size:
+            f.readline()
+        end = f.tell()
+        ranges.append((start, end))
+        start = end
+    return ranges
+
+
+def count_range(task):
+    (path, start, end, ndests, total, link, dest) = task
+    link_out = StringIO() if link else None
+    with open(path, 'rb') as f:
+        f.seek(start)
+        lines = f.read(end - start).splitlines()
+    (totals, ntokens, dest_counts) = count_rows(lines, ndests, total, link_out, dest)
+    return (totals, ntokens, dest_counts, link_out.getvalue() if link else "")
+
+
+# Same as analyze, but the rows are counted by a pool of worker processes,
+# one byte range at a time, and the partial counts merged afterwards
+def analyze_parallel(path, jobs, total_out=None, link_out=None, dest_out=None,
+                     routes=False):
+    with open(path, 'rb') as f:
+        dests = read_header(f.readline(), routes)
+        ranges = byte_ranges(f, jobs)
+    tasks = [(path, start, end, len(dests), total_out is not None,
+              link_out is not None, dest_out is not None) for (start, end) in ranges]
+    totals = [0] * len(CLASSES)
+    ntokens = 0
+    dest_counts = [[0] * len(dests) for k in CLASSES]
+    pool = Pool(jobs)
+    for (t, n, d, text) in pool.imap(count_range, tasks):
+        if link_out is not None:
+            link_out.write(text)
+        ntokens += n
+        for k in xrange(0, len(CLASSES)):
+            totals[k] += t[k]
+        if dest_out is not None:
+            for k in xrange(0, len(CLASSES)):
+                for idx in xrange(0, len(dests)):
+                    dest_counts[k][idx] += d[k][idx]
+    pool.close()
+    pool.join()
+    if dest_out is not None:
+        write_dests(dest_out, dests, dest_counts)
+    if total_out is not None:
+        write_totals(total_out, totals, ntokens)
+
+
+class PipeFile(object):
+    """A pipe to or from a (de)compressor that waits for it on close."""
+    def __init__(self, tool, proc, f):
+        self.tool = tool
+        self.proc = proc
+        self.f = f
+
+    def __getattr__(self, name):
+        return getattr(self.f, name)
+
+    def __iter__(self):
+        return iter(self.f)
+
+    def close(self):
+        self.f.close()
+        if self.proc.wait() != 0:
+            raise IOError("%s exited with %d" % (self.tool, self.proc.returncode))
+
+
+def compressor(name):
+    return COMPRESSORS.get(os.path.splitext(name)[1])
+
+
+def open_input(name):
+    if name == "-":
+        return sys.stdin
+    tool = compressor(name)
+    if tool is None:
+        return open(name)
+    proc = subprocess.Popen([tool, '-dc', name], stdout=subprocess.PIPE, bufsize=1 << 20)
+    return PipeFile(tool, proc, proc.stdout)
+
+
+def open_report(name):
+    if name is None:
+        return None
+    if name == "-":
+        return sys.stdout
+    tool = compressor(name)
+    if tool is None:
+        return open(name, 'w', 1 << 20)
+    with open(name, 'wb') as out:
+        proc = subprocess.Popen([tool, '-c'], stdin=subprocess.PIPE, stdout=out, bufsize=1 << 20)
+    return PipeFile(tool, proc, proc.stdin)
+
+
+def close_reports(outs):
+    for out in outs:
+        if out is not None and out is not sys.stdout:
+            out.close()
+
+
+def parse_args():
+    parser = OptionParser(usage="%prog [options] file\n\n" +
+        "file may be gzip (.gz) or zstd (.zst) compressed, or - for stdin")
+    parser.add_option("--total", metavar="FILE",
+        help="Write the fraction of each class over the whole file " +
+             "(as process.py), - for stdout")
+    parser.add_option("--by-link", metavar="FILE",
+        help="Write class counts per link (as analyze_by_link.py)")
+    parser.add_option("--by-dest", metavar="FILE",
+        help="Write class counts per destination (as analyze_by_dest.py)")
+    parser.add_option("--matrix", action="store_true", default=False,
+        help="Load the file as a cached NumPy matrix (see result_matrix.py) " +
+             "and count with bincount")
+    parser.add_option("-j", "--jobs", type="int", default=1,
+        help="Count byte ranges of the file in this many processes")
+    parser.add_option("--routes", action="store_true", default=False,
+        help="Accept routes.py output, whose classes are not SMPC results")
+    (opts, args) = parser.parse_args()
+    if len(args) < 1 or (opts.total, opts.by_link, opts.by_dest) == (None, None, None):
+        parser.print_help()
+        sys.exit(1)
+    return (opts, args[0])
+
+
+def main():
+    (opts, result_file) = parse_args()
+    if (opts.matrix or opts.jobs > 1) and (result_file == "-" or compressor(result_file)):
+        print >>sys.stderr, "--matrix and --jobs need an uncompressed file"
+        sys.exit(1)
+    outs = [open_report(opts.total), open_report(opts.by_link), open_report(opts.by_dest)]
+    if opts.matrix:
+        import result_matrix
+        result_matrix.report(result_matrix.load(result_file, opts.routes),
+                             outs[0], outs[1], outs[2])
+    elif opts.jobs > 1:
+        analyze_parallel(result_file, opts.jobs, outs[0], outs[1], outs[2], opts.routes)
+    else:
+        f = open_input(result_file)
+        analyze(f, outs[0], outs[1], outs[2], opts.routes)
+    close_reports(outs)
+
+
+if __name__ == "__main__":
+    main()
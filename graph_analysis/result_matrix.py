@@ -0,0 +1,160 @@
+"""Dense NumPy view of SMPC result files.
+
+A result file is a links x destinations matrix of class codes 0-4, with the
+two endpoints of each link in the first two columns.  ``load`` turns it into
+a ``uint8`` matrix plus key arrays and keeps them as ``.npy`` files under
+``CACHE_DIR`` (``$SMIRC_RESULT_CACHE``), so later loads just memory-map them.
+The reports from ``analyze.py`` then become per-class counts over the matrix.
+"""
+import hashlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import numpy
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import topology
+import analyze
+
+CACHE_DIR = os.environ.get('SMIRC_RESULT_CACHE',
+    os.path.join(os.path.expanduser('~'), '.cache', 'smirc-tools', 'results'))
+# Classes (rows x destinations) processed at a time when converting or
+# reporting
+CHUNK_CELLS = 1 << 24
+
+
+def chunk_rows(ndests):
+    return max(1, CHUNK_CELLS // max(ndests, 1))
+
+
+class ResultMatrix(object):
+    def __init__(self, classes, src, dst, dests):
+        self.classes = classes
+        self.src = src
+        self.dst = dst
+        self.dests = dests
+
+
+def cache_path(path):
+    return os.path.join(CACHE_DIR, hashlib.sha1(os.path.abspath(path)).hexdigest())
+
+
+def _source_key(path):
+    st = os.stat(path)
+    return {'path': os.path.abspath(path), 'size': st.st_size, 'mtime': st.st_mtime}
+
+
+# Tokens are single digits, so the classes of a row are just the characters
+# of its joined tokens; the digits of all rows are spooled to a raw file and
+# copied into the .npy once the row count is known.
+def parse(f, out_dir, routes=False):
+    dests = analyze.read_header(f.readline(), routes)
+    src = []
+    dst = []
+    with tempfile.TemporaryFile(dir=out_dir) as raw:
+        for l in f:
+            p = l.split()
+            if not p:
+                continue
+            digits = ''.join(p[2:])
+            if len(p) - 2 != len(dests) or len(digits) != len(dests):
+                raise analyze.bad_row(' '.join(p[:2]), len(p) - 2, len(dests))
+            src.append(p[0])
+            dst.append(p[1])
+            raw.write(digits)
+        raw.seek(0)
+        classes = numpy.lib.format.open_memmap(os.path.join(out_dir, 'classes.npy'),
+            mode='w+', dtype=numpy.uint8, shape=(len(src), len(dests)))
+        step = chunk_rows(len(dests))
+        for start in xrange(0, len(src), step):
+            n = min(step, len(src) - start)
+            chunk = numpy.fromfile(raw, dtype=numpy.uint8, count=n * len(dests)) - ord('0')
+            # Anything but 0-4 (including wrapped-around bytes below '0')
+            bad = numpy.nonzero(chunk >= len(analyze.CLASSES))[0]
+            if len(bad) > 0:
+                row = start + bad[0] // len(dests)
+                raise analyze.bad_row('%s %s' % (src[row], dst[row]),
+                                      len(dests), len(dests))
+            classes[start:start + n] = chunk.reshape(n, len(dests))
+        classes.flush()
+        del classes
+    numpy.save(os.path.join(out_dir, 'src.npy'), numpy.array(src, dtype=str))
+    numpy.save(os.path.join(out_dir, 'dst.npy'), numpy.array(dst, dtype=str))
+    numpy.save(os.path.join(out_dir, 'dests.npy'), numpy.array(dests, dtype=str))
+
+
+def read_cache(out_dir):
+    mmap = lambda name: numpy.load(os.path.join(out_dir, name), mmap_mode='r')
+    return ResultMatrix(mmap('classes.npy'), mmap('src.npy'), mmap('dst.npy'),
+                        mmap('dests.npy'))
+
+
+def load(path, routes=False):
+    """Load a result file, converting it into the cache if it changed.
+
+    routes.py output raises ValueError unless routes is set, cached or not.
+    """
+    with open(path) as f:
+        analyze.read_header(f.readline(), routes)
+    key = _source_key(path)
+    cached = cache_path(path)
+    meta_file = os.path.join(cached, 'meta.json')
+    if os.path.exists(meta_file):
+        with open(meta_file) as m:
+            meta = json.load(m)
+        if meta['path'] == key['path'] and meta['size'] == key['size']:
+            if meta['mtime'] == key['mtime']:
+                return read_cache(cached)
+            if meta['sha1'] == topology.file_hash(path):
+                # Only touched, remember the new mtime
+                key['sha1'] = meta['sha1']
+                with open(meta_file, 'w') as m:
+                    json.dump(key, m)
+                return read_cache(cached)
+    if not os.path.isdir(CACHE_DIR):
+        os.makedirs(CACHE_DIR)
+    tmp = tempfile.mkdtemp(dir=CACHE_DIR)
+    try:
+        with open(path) as f:
+            parse(f, tmp, routes)
+    except:
+        shutil.rmtree(tmp)
+        raise
+    key['sha1'] = topology.file_hash(path)
+    with open(os.path.join(tmp, 'meta.json'), 'w') as m:
+        json.dump(key, m)
+    if os.path.isdir(cached):
+        shutil.rmtree(cached)
+    os.rename(tmp, cached)
+    return read_cache(cached)
+
+
+# Count classes along rows (axis=1, one count per link) or columns (axis=0,
+# one count per destination), one class at a time so the only temporary is
+# a boolean mask the size of the chunk.
+def class_counts(chunk, axis):
+    return numpy.column_stack([(chunk == k).sum(axis=axis)
+                               for k in xrange(0, len(analyze.CLASSES))])
+
+
+# Same reports as analyze.analyze, computed from the matrix
+def report(rm, total_out=None, link_out=None, dest_out=None):
+    (nrows, ndests) = rm.classes.shape
+    totals = numpy.zeros(len(analyze.CLASSES), dtype=numpy.int64)
+    dest_counts = numpy.zeros((ndests, len(analyze.CLASSES)), dtype=numpy.int64)
+    step = chunk_rows(ndests)
+    for start in xrange(0, nrows, step):
+        chunk = numpy.asarray(rm.classes[start:start + step])
+        if link_out is not None:
+            counts = class_counts(chunk, 1).tolist()
+            for i in xrange(0, len(counts)):
+                analyze.write_link(link_out, rm.src[start + i], rm.dst[start + i], counts[i])
+        if total_out is not None:
+            totals += [numpy.count_nonzero(chunk == k) for k in xrange(0, len(analyze.CLASSES))]
+        if dest_out is not None:
+            dest_counts += class_counts(chunk, 0)
+    if dest_out is not None:
+        analyze.write_dests(dest_out, rm.dests.tolist(), dest_counts.T.tolist())
+    if total_out is not None:
+        analyze.write_totals(total_out, totals.tolist(), nrows * ndests)
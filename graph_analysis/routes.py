@@ -0,0 +1,229 @@
+"""Valley-free (Gao-Rexford) best routes, computed locally.
+
+For every destination, each node picks its best route by preferring
+customer routes over peer routes over provider routes, then the shortest
+path, then the lowest next-hop id. A node only exports customer routes (and
+its own prefix) to peers and providers, and exports every route to its
+customers. The routes are found in three frontier passes over the CSR
+arrays of topology.py: customer routes spread up c2p links level by level
+from the destination, peer routes take one p2p hop from there, and
+provider routes spread down p2c links in order of path length.
+Destinations are routed in blocks, which are gathered in a scratch matrix
+on disk (--tmp-dir) before the rows are written, so memory use does not
+grow with the number of destinations.
+
+The output is a result file as graph_analysis/ reads it: a header
+``routes src dst <destinations>``, then one row per link ``src dst`` (node ids, in
+topology order) with one class per destination:
+
+    0  the destination is not routed over this link
+    1  src's best route goes over this link and is a customer route
+    2  ... a peer route
+    3  ... a provider route
+    4  src has no valley-free route to the destination at all
+
+These are not the SMPC classes, so the header starts with ``routes`` and
+analyze.py only reads the file when given --routes.
+"""
+import os
+import shutil
+import sys
+import tempfile
+from multiprocessing import Pool
+from optparse import OptionParser
+import numpy
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import topology
+from topology import P2C, P2P, C2P
+import analyze
+
+NO_ROUTE = 4
+# Destinations handed to a worker at a time
+CHUNK = 64
+# Result rows formatted per write
+BATCH = 4096
+
+
+class RouteEngine(object):
+    def __init__(self, topo):
+        self.topo = topo
+        self.offsets = numpy.asarray(topo.offsets, dtype=numpy.int64)
+        self.neighbors = numpy.asarray(topo.neighbors, dtype=numpy.int64)
+        self.rels = numpy.asarray(topo.rels, dtype=numpy.uint8)
+        # Source node of every link
+        self.sources = numpy.repeat(numpy.arange(len(self.offsets) - 1),
+                                    numpy.diff(self.offsets))
+        # The link back the other way, -1 if the file only has one direction
+        n = len(self.offsets)
+        keys = self.sources * n + self.neighbors
+        order = numpy.argsort(keys, kind='mergesort')
+        back = self.neighbors * n + self.sources
+        pos = numpy.minimum(numpy.searchsorted(keys[order], back), len(keys) - 1)
+        self.reverse = numpy.where(keys[order][pos] == back, order[pos], -1)
+
+    # Indices of the links out of the frontier nodes that have class rel
+    def _links(self, frontier, rel):
+        starts = self.offsets[frontier]
+        counts = self.offsets[frontier + 1] - starts
+        if counts.sum() == 0:
+            return numpy.zeros(0, dtype=numpy.int64)
+        ends = numpy.cumsum(counts)
+        links = numpy.arange(ends[-1]) + numpy.repeat(starts - (ends - counts), counts)
+        return links[self.rels[links] == rel]
+
+    # Give every node not routed yet that one of links leads to the route
+    # over the best of them: shortest, then lowest next hop. A node's hop is
+    # its own link back to the next hop. Returns the newly routed nodes.
+    def _offer(self, links, dist, hop):
+        targets = self.neighbors[links]
+        fresh = dist[targets] < 0
+        (links, targets) = (links[fresh], targets[fresh])
+        if len(links) == 0:
+            return targets
+        via = self.sources[links]
+        length = dist[via] + 1
+        order = numpy.lexsort((via, length, targets))
+        (links, targets) = (links[order], targets[order])
+        first = numpy.ones(len(targets), dtype=bool)
+        first[1:] = targets[1:] != targets[:-1]
+        (links, targets) = (links[first], targets[first])
+        dist[targets] = dist[self.sources[links]] + 1
+        hop[targets] = self.reverse[links]
+        return targets
+
+    def routes(self, dest):
+        """Path length and next-hop link of every node's route to dest, -1 if none."""
+        n = len(self.offsets) - 1
+        dist = numpy.empty(n, dtype=numpy.int64)
+        dist.fill(-1)
+        hop = numpy.empty(n, dtype=numpy.int64)
+        hop.fill(-1)
+        dist[dest] = 0
+        # Customer routes, up the provider chains from dest
+        frontier = numpy.array([dest])
+        while len(frontier) > 0:
+            frontier = self._offer(self._links(frontier, C2P), dist, hop)
+        # Peer routes, one hop from dest or a node with a customer route
+        self._offer(self._links(numpy.nonzero(dist >= 0)[0], P2P), dist, hop)
+        # Provider routes, down to customers in order of length
+        length = 0
+        while length <= dist.max():
+            frontier = numpy.nonzero(dist == length)[0]
+            self._offer(self._links(frontier, P2C), dist, hop)
+            length += 1
+        return (dist, hop)
+
+    def classes(self, dest):
+        """The result file column for dest: a class for every link."""
+        (dist, hop) = self.routes(dest)
+        column = numpy.zeros(len(self.neighbors), dtype=numpy.uint8)
+        used = hop[hop >= 0]
+        column[used] = self.rels[used] + 1
+        cut_off = dist < 0
+        cut_off[0] = False
+        column[cut_off[self.sources]] = NO_ROUTE
+        return column
+
+
+_engine = None
+
+
+def init_worker(path):
+    global _engine
+    _engine = RouteEngine(topology.load(path))
+
+
+def route_chunk(job):
+    (start, dests) = job
+    return (start, numpy.column_stack([_engine.classes(d) for d in dests]))
+
+
+# Class columns (links x destinations) for blocks of destinations, as
+# (first destination index, block) pairs in the order they finish. With
+# jobs > 1 the blocks are spread over processes, which load the topology
+# themselves, from the cache.
+def route_blocks(path, engine, dests, jobs):
+    chunks = [(i, dests[i:i + CHUNK]) for i in xrange(0, len(dests), CHUNK)]
+    if jobs <= 1 or len(chunks) <= 1:
+        for (start, chunk) in chunks:
+            yield (start, numpy.column_stack([engine.classes(d) for d in chunk]))
+        return
+    pool = Pool(jobs, init_worker, (path,))
+    try:
+        for block in pool.imap_unordered(route_chunk, chunks):
+            yield block
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+# Gather the blocks into a scratch .npy under tmp_dir. It is column major,
+# so each block is one contiguous write, and the whole matrix is never held
+# in memory.
+def route_all(path, engine, dests, jobs, tmp_dir):
+    classes = numpy.lib.format.open_memmap(os.path.join(tmp_dir, 'classes.npy'),
+        mode='w+', dtype=numpy.uint8, shape=(len(engine.neighbors), len(dests)),
+        fortran_order=True)
+    for (start, block) in route_blocks(path, engine, dests, jobs):
+        classes[:, start:start + block.shape[1]] = block
+    return classes
+
+
+def write_results(out, engine, dests, classes):
+    out.write('%s src dst %s\n' % (analyze.ROUTES_TAG, ' '.join(str(d) for d in dests)))
+    if dests == []:
+        return
+    width = 2 * len(dests)
+    for start in xrange(0, len(engine.neighbors), BATCH):
+        block = numpy.asarray(classes[start:start + BATCH])
+        text = numpy.empty((len(block), width), dtype=numpy.uint8)
+        text[:, 0::2] = block + ord('0')
+        text[:, 1::2] = ord(' ')
+        text[:, -1] = ord('\n')
+        rows = text.view('S%d' % width).ravel()
+        src = engine.sources[start:start + BATCH].tolist()
+        dst = engine.neighbors[start:start + BATCH].tolist()
+        out.write(''.join(['%d %d %s' % row for row in zip(src, dst, rows)]))
+
+
+def parse_args():
+    parser = OptionParser(usage="%prog [options] topology\n\n" +
+        "The output may be gzip (.gz) or zstd (.zst) compressed")
+    parser.add_option("-d", "--dest", action="append", default=[],
+        help="AS to compute routes to, may be repeated (default: every AS)")
+    parser.add_option("-o", "--output", default="-",
+        help="File to write the results to (default: stdout)")
+    parser.add_option("-j", "--jobs", type="int", default=1,
+        help="Spread destinations over this many processes")
+    parser.add_option("-t", "--tmp-dir", default=None,
+        help="Directory for the scratch links x destinations matrix " +
+             "(default: $TMPDIR)")
+    (opts, args) = parser.parse_args()
+    if len(args) < 1:
+        parser.print_help()
+        sys.exit(1)
+    return (opts, args[0])
+
+
+def main():
+    (opts, topo_file) = parse_args()
+    topo = topology.load(topo_file)
+    engine = RouteEngine(topo)
+    try:
+        dests = [topo.node_id(d) for d in opts.dest] or list(topo.nodes())
+    except KeyError as e:
+        print >>sys.stderr, "AS %s is not in %s" % (e.args[0], topo_file)
+        sys.exit(1)
+    tmp = tempfile.mkdtemp(dir=opts.tmp_dir)
+    try:
+        classes = route_all(topo_file, engine, dests, opts.jobs, tmp)
+        out = analyze.open_report(opts.output)
+        write_results(out, engine, dests, classes)
+        analyze.close_reports([out])
+        del classes
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == "__main__":
+    main()
@@ -19,24 +19,159 @@
 
 from __future__ import with_statement
 
+import atexit
+import hashlib
+import json
 import logging
 import os
+import Queue
 import random
 import shutil
+import socket
 import subprocess
 import sys
+import tarfile
 import tempfile
+import threading
 import time
 import urllib2
-from optparse import OptionParser
+import urlparse
+from contextlib import contextmanager
+from cStringIO import StringIO
+from multiprocessing.pool import ThreadPool
+from optparse import OptionGroup, OptionParser
 from sys import stderr
 import boto
 from boto.ec2.blockdevicemapping import BlockDeviceMapping, EBSBlockDeviceType
 from boto import ec2
+from boto.regioninfo import RegionInfo
+import ec2sim
 
 # A static URL from which to figure out the latest Mesos EC2 AMI
 LATEST_AMI_URL = "https://s3.amazonaws.com/mesos-images/ids/latest-spark-0.7"
 
+# Seconds a shared SSH connection stays up after its last use
+CONTROL_PERSIST = 600
+
+# Seconds before a readiness probe connection gives up
+PROBE_TIMEOUT = 5
+
+# Bounds, in seconds, of the backoff between instance state polls
+POLL_INITIAL = 2
+POLL_MAX = 30
+# SMPC binaries that --distribute=fanout copies from the master
+BINARIES = ["input", "compute"]
+BINARY_TARBALL = "smpc-bin.tgz"
+# Name of the topology tarball on hosts
+TOPO_TARBALL = "smpc-topo.tgz"
+# Where go get fetches SMPC from
+SMPC_REPO = "https://github.com/apanda/smpc"
+
+
+# Timing of launch phases and per-host commands. Spans can be recorded from
+# any thread. With --trace they are also written out, as JSON lines while
+# they finish or as one Chrome trace (chrome://tracing) once the action ends.
+class Tracer(object):
+  def __init__(self):
+    self.origin = time.time()
+    self.spans = []
+    self.lock = threading.Lock()
+    self.out = None
+    self.format = "jsonl"
+
+  def open(self, path, format):
+    self.out = open(path, "w")
+    self.format = format
+
+  def record(self, span):
+    with self.lock:
+      self.spans.append(span)
+      if self.out != None and self.format == "jsonl":
+        self.out.write(json.dumps(span, sort_keys=True) + "\n")
+        self.out.flush()
+
+  def close(self):
+    if self.out == None:
+      return
+    if self.format == "chrome":
+      json.dump(chrome_trace(self.spans), self.out)
+    self.out.close()
+    self.out = None
+
+TRACER = Tracer()
+
+
+# Time the enclosed block as a span called name, optionally tied to a host
+# and carrying extra args
+@contextmanager
+def timed(name, host=None, **args):
+  start = time.time()
+  ok = False
+  try:
+    yield
+    ok = True
+  finally:
+    span = {"name": name, "start": round(start - TRACER.origin, 6),
+            "duration": round(time.time() - start, 6), "ok": ok,
+            "thread": threading.current_thread().name}
+    if host != None:
+      span["host"] = host
+    if args != {}:
+      span["args"] = args
+    TRACER.record(span)
+
+
+# Decorator timing every call of a function; with per_host, its first
+# argument is the host the span belongs to
+def traced(name, per_host=False):
+  def wrap(fn):
+    def call(*args, **kwargs):
+      with timed(name, args[0] if per_host else None):
+        return fn(*args, **kwargs)
+    call.__name__ = fn.__name__
+    call.__doc__ = fn.__doc__
+    return call
+  return wrap
+
+
+# Spans as Chrome trace events, one row per host (or per thread for spans
+# without one)
+def chrome_trace(spans):
+  rows = {}
+  events = []
+  for span in spans:
+    row = span.get("host", span["thread"])
+    tid = rows.setdefault(row, len(rows) + 1)
+    args = dict(span.get("args", {}))
+    args["ok"] = span["ok"]
+    events.append({"name": span["name"], "ph": "X", "pid": 1, "tid": tid,
+                   "ts": int(span["start"] * 1e6),
+                   "dur": int(span["duration"] * 1e6), "args": args})
+  for (row, tid) in rows.items():
+    events.append({"name": "thread_name", "ph": "M", "pid": 1, "tid": tid,
+                   "args": {"name": row}})
+  return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+
+# Print where the time went, one line per span name in order of first
+# appearance, with the slowest host for per-host spans
+def print_trace_summary():
+  names = []
+  by_name = {}
+  for span in sorted(TRACER.spans, key=lambda s: s["start"]):
+    if span["name"] not in by_name:
+      names.append(span["name"])
+    by_name.setdefault(span["name"], []).append(span)
+  if names == []:
+    return
+  print >> stderr, "%-20s %6s %9s %9s  %s" % ("Phase", "Count", "Total(s)", "Max(s)", "Slowest host")
+  for name in names:
+    spans = by_name[name]
+    slowest = max(spans, key=lambda s: s["duration"])
+    print >> stderr, "%-20s %6d %9.1f %9.1f  %s" % (
+        name, len(spans), sum(s["duration"] for s in spans),
+        slowest["duration"], slowest.get("host", ""))
+
 
 # Configure and parse our command-line arguments
 def parse_args():
@@ -49,8 +184,12 @@ def parse_args():
       help="Number of slaves to launch (default: 1)")
   parser.add_option("-g", "--compute-groups", type="int", default=1,
       help="Computational groups to launch")
-  parser.add_option("-w", "--wait", type="int", default=120,
-      help="Seconds to wait for nodes to start (default: 120)")
+  parser.add_option("-w", "--wait", type="int", default=0,
+      help="Extra seconds to wait once nodes are running, on top of " +
+           "probing them for SSH (default: 0)")
+  parser.add_option("--probe-ssh", action="store_true", default=False,
+      help="Only consider a node ready once an SSH command succeeds on " +
+           "it, rather than once its SSH port accepts connections")
   parser.add_option("-k", "--key-pair",
       help="Key pair to use on instances")
   parser.add_option("-i", "--identity-file", 
@@ -84,10 +223,75 @@ def parse_args():
   parser.add_option("--spot-price", metavar="PRICE", type="float",
       help="If specified, launch slaves as spot instances with the given " +
             "maximum price (in dollars)")
+  parser.add_option("--spot-timeout", metavar="SECS", type="int", default=900,
+      help="Seconds to wait for spot requests to be granted before falling " +
+           "back to --spot-fallback, 0 to wait forever (default: 900)")
+  parser.add_option("--spot-fallback", default="on-demand",
+      choices=["on-demand", "fewer-groups", "abort"],
+      help="What to do about spot requests still unfilled after " +
+           "--spot-timeout: launch on-demand instances in their place, " +
+           "continue with as many compute groups as were granted, or " +
+           "abort (default: on-demand)")
+  parser.add_option("--distribute", default="build", choices=["build", "fanout"],
+      help="How compute nodes get the SMPC binaries: 'build' runs go get " +
+           "on every node, 'fanout' builds once on the master and copies " +
+           "the binaries out over a tree of nodes (default: build)")
+  parser.add_option("--full-setup", action="store_true", default=False,
+      help="Set up every host again, even those whose configuration, " +
+           "SMPC revision and topology are unchanged since their last setup")
+  parser.add_option("--backend", default="ec2", choices=["ec2", "sim"],
+      help="Where clusters live: 'ec2', or 'sim' for a local simulation of " +
+           "EC2 and the hosts, to benchmark launches offline (default: ec2)")
+  parser.add_option("--trace", metavar="FILE", default="",
+      help="Write the timing of every phase and per-host command to FILE")
+  parser.add_option("--trace-format", default="jsonl", choices=["jsonl", "chrome"],
+      help="Format of --trace: JSON lines, or a Chrome trace viewable in " +
+           "chrome://tracing (default: jsonl)")
   parser.add_option("--delete-groups", action="store_true", default=False,
       help="When destroying a cluster, delete the security groups that were created")
-  parser.add_option("--topo", default="", help="Topology to upload")
+  parser.add_option("--topo", default="",
+      help="Topology file or directory to upload; only files that differ " +
+           "from the master's copy are sent")
+  parser.add_option("--topo-to-compute", action="store_true", default=False,
+      help="Also copy --topo to every compute and redis node, fanned out " +
+           "from the master")
+  parser.add_option("-p", "--parallelism", type="int", default=10,
+      help="Number of hosts to configure at once (default: 10)")
+  parser.add_option("--launch-timeout", type="int", default=900,
+      help="Seconds to wait for instances to leave the pending state " +
+           "(default: 900)")
+  parser.add_option("--ec2-endpoint", metavar="URL", default="",
+      help="EC2 API endpoint to use instead of the region's, e.g. a local " +
+           "mock such as http://localhost:5000")
+  parser.add_option("--state-dir", default="~/.smpc-clusters",
+      help="Directory for the local record of each cluster's instances " +
+           "(default: ~/.smpc-clusters)")
+  parser.add_option("--refresh", action="store_true", default=False,
+      help="Search EC2 for the cluster's instances even if they are " +
+           "recorded locally")
+  parser.add_option("-u", "--user", default="ubuntu",
+      help="User to log into instances as (default: ubuntu)")
+  parser.add_option("--no-multiplex", action="store_true", default=False,
+      help="Open a new SSH connection for every command instead of " +
+           "sharing one per host")
             
+  sim = OptionGroup(parser, "Simulator options",
+      "With --backend=sim, EC2 and the hosts are simulated in this process " +
+      "(see ec2sim.py), so a launch can be timed offline. Times are means; " +
+      "each draw is uniform within +/-50%.")
+  sim.add_option("--sim-boot-time", metavar="SECS", type="float", default=20,
+      help="Time instances stay pending (default: 20)")
+  sim.add_option("--sim-spot-delay", metavar="SECS", type="float", default=30,
+      help="Time until a spot request is fulfilled (default: 30)")
+  sim.add_option("--sim-spot-fill", metavar="FRACTION", type="float", default=1.0,
+      help="Share of spot requests that are ever fulfilled (default: 1.0)")
+  sim.add_option("--sim-command-time", metavar="SECS", type="float", default=1.0,
+      help="Time each ssh or scp takes (default: 1)")
+  sim.add_option("--sim-failure-rate", metavar="P", type="float", default=0.0,
+      help="Probability that an ssh or scp fails (default: 0)")
+  sim.add_option("--sim-seed", type="int",
+      help="Random seed for the simulator")
+  parser.add_option_group(sim)
   (opts, args) = parser.parse_args()
   if len(args) != 2:
     parser.print_help()
@@ -101,7 +305,8 @@ def parse_args():
   # Boto config check
   # http://boto.cloudhackers.com/en/latest/boto_config_tut.html
   home_dir = os.getenv('HOME')
-  if home_dir == None or not os.path.isfile(home_dir + '/.boto'):
+  if opts.backend == "ec2" and \
+      (home_dir == None or not os.path.isfile(home_dir + '/.boto')):
     if not os.path.isfile('/etc/boto.cfg'):
       if os.getenv('AWS_ACCESS_KEY_ID') == None:
         print >> stderr, ("ERROR: The environment variable AWS_ACCESS_KEY_ID " +
@@ -125,16 +330,48 @@ def get_or_make_group(conn, name):
     return conn.create_security_group(name, "Spark EC2 group")
 
 
+# Successive sleeps between polls: exponential backoff from POLL_INITIAL up
+# to POLL_MAX seconds, with jitter so that clients do not poll in lockstep
+def backoff_delays(initial=POLL_INITIAL, maximum=POLL_MAX):
+  delay = initial
+  while True:
+    yield random.uniform(delay / 2.0, delay)
+    delay = min(delay * 2, maximum)
+
+
+# Describe a set of instances with a single call, returning the fresh
+# objects in the same order. Instances the call does not return yet are
+# kept as they were.
+def update_instances(conn, instances):
+  fresh = {}
+  for res in conn.get_all_instances(instance_ids=[i.id for i in instances]):
+    for i in res.instances:
+      fresh[i.id] = i
+  return [fresh.get(i.id, i) for i in instances]
+
+
 # Wait for a set of launched instances to exit the "pending" state
-# (i.e. either to start running or to fail and be terminated)
-def wait_for_instances(conn, instances):
+# (i.e. either to start running or to fail and be terminated), giving up
+# after timeout seconds. Returns the instances as last described.
+@traced("wait_for_instances")
+def wait_for_instances(conn, instances, timeout):
+  deadline = time.time() + timeout
+  delays = backoff_delays()
   while True:
-    for i in instances:
-      i.update()
-    if len([i for i in instances if i.state == 'pending']) > 0:
-      time.sleep(5)
-    else:
-      return
+    try:
+      instances = update_instances(conn, instances)
+    except boto.exception.EC2ResponseError as e:
+      # Instances can take a moment to show up after they are launched
+      if e.error_code != "InvalidInstanceID.NotFound":
+        raise
+    pending = [i for i in instances if i.state == 'pending']
+    if pending == []:
+      return instances
+    if time.time() >= deadline:
+      print >> stderr, ("ERROR: %d instances still pending after %d seconds: %s" %
+                        (len(pending), timeout, " ".join(i.id for i in pending)))
+      sys.exit(1)
+    time.sleep(max(0, min(next(delays), deadline - time.time())))
 
 
 # Check whether a given EC2 instance object is in a state we consider active,
@@ -144,11 +381,217 @@ def is_active(instance):
   return (instance.state in ['pending', 'running', 'stopping', 'stopped'])
 
 
+# Output from worker threads goes through log, which writes each line in one
+# locked write. A bare print writes the message and its newline separately,
+# so lines from different threads run together.
+OUTPUT_LOCK = threading.Lock()
+
+
+def log(message, out=sys.stdout):
+  with OUTPUT_LOCK:
+    out.write(message + "\n")
+    out.flush()
+
+
+# Call every function in fns at once, each on its own thread, and return
+# their results in order. The first exception raised is re-raised.
+def call_concurrently(fns):
+  if len(fns) <= 1:
+    return [fn() for fn in fns]
+  pool = ThreadPool(len(fns))
+  try:
+    return pool.map(lambda fn: fn(), fns)
+  finally:
+    pool.close()
+    pool.join()
+
+
+# Start fn(*args) on a thread of its own. The result's get() waits for it
+# and returns its value or re-raises its exception.
+def start_call(fn, *args):
+  pool = ThreadPool(1)
+  result = pool.apply_async(fn, args)
+  pool.close()
+  return result
+
+
+# Split count over zones as (zone, count) pairs, skipping empty zones
+def zone_counts(count, zones):
+  counts = [(zone, get_partition(count, len(zones), i)) for (i, zone) in enumerate(zones)]
+  return [(zone, n) for (zone, n) in counts if n > 0]
+
+
+# Launch count compute nodes as on-demand instances spread over zones,
+# with the launches in all zones issued at once
+def launch_on_demand(conn, image, opts, compute_group, block_map, count, zones):
+  def run(zone, n):
+    with timed("image.run", zone=zone, count=n):
+      compute_res = image.run(key_name = opts.key_pair,
+                              security_groups = [compute_group],
+                              instance_type = opts.instance_type,
+                              placement = zone,
+                              min_count = n,
+                              max_count = n,
+                              block_device_map = block_map)
+    log("Launched %d compute nodes in %s, regid = %s" % (n, zone, compute_res.id))
+    return compute_res.instances
+  launches = [lambda zone=zone, n=n: run(zone, n) for (zone, n) in zone_counts(count, zones)]
+  return sum(call_concurrently(launches), [])
+
+
+# Request count compute nodes as spot instances spread over zones, with
+# the requests for all zones issued at once. Returns the request ids.
+def request_spot(conn, opts, cluster_name, compute_group, block_map, count, zones):
+  def request(zone, n):
+    with timed("request_spot", zone=zone, count=n):
+      compute_reqs = conn.request_spot_instances(
+          price = opts.spot_price,
+          image_id = opts.ami,
+          launch_group = "launch-group-%s" % cluster_name,
+          placement = zone,
+          count = n,
+          key_name = opts.key_pair,
+          security_groups = [compute_group],
+          instance_type = opts.instance_type,
+          block_device_map = block_map)
+    return [req.id for req in compute_reqs]
+  requests = [lambda zone=zone, n=n: request(zone, n) for (zone, n) in zone_counts(count, zones)]
+  return sum(call_concurrently(requests), [])
+
+
+# Launch the input node in opts.zone
+def launch_input(image, opts, input_group, block_map):
+  input_type = opts.instance_type
+  if input_type == "":
+    input_type = opts.instance_type
+  with timed("image.run", zone=opts.zone, count=1):
+    input_res = image.run(key_name = opts.key_pair,
+                           security_groups = [input_group],
+                           instance_type = input_type,
+                           placement = opts.zone,
+                           min_count = 1,
+                           max_count = 1,
+                           block_device_map = block_map)
+  log("Launched input in %s, regid = %s" % (opts.zone, input_res.id))
+  return input_res.instances
+
+
+# Terminate the input node started alongside a compute launch that is
+# being abandoned
+def abandon_input(input_launch):
+  try:
+    input_nodes = input_launch.get()
+  except Exception:
+    return
+  for inst in input_nodes:
+    inst.terminate()
+
+
+# Wait for our spot requests to be fulfilled, polling just those requests
+# with backoff. Returns the ids of the granted instances and of the
+# requests still open, once all wanted instances are granted or
+# opts.spot_timeout seconds have passed (if it is positive).
+@traced("spot_wait")
+def wait_for_spot_requests(conn, opts, req_ids, wanted):
+  deadline = time.time() + opts.spot_timeout
+  delays = backoff_delays()
+  while True:
+    time.sleep(next(delays))
+    try:
+      reqs = conn.get_all_spot_instance_requests(request_ids=req_ids)
+    except boto.exception.EC2ResponseError as e:
+      # New requests can take a moment to show up
+      if e.error_code != "InvalidSpotInstanceRequestID.NotFound":
+        raise
+      continue
+    active_instance_ids = [r.instance_id for r in reqs if r.state == "active"]
+    if len(active_instance_ids) >= wanted:
+      log("All %d compute nodes granted" % wanted)
+      return (active_instance_ids, [])
+    log("%d of %d compute nodes granted, waiting longer" % (
+      len(active_instance_ids), wanted))
+    if opts.spot_timeout > 0 and time.time() >= deadline:
+      return (active_instance_ids,
+              [r.id for r in reqs if r.state != "active"])
+
+
+# Cancel spot requests, returning the ids of any instances they launched
+# before the cancellation went through
+def cancel_spot_requests(conn, req_ids):
+  conn.cancel_spot_instance_requests(req_ids)
+  reqs = conn.get_all_spot_instance_requests(request_ids=req_ids)
+  return [r.instance_id for r in reqs if r.instance_id]
+
+
+# Launch the compute nodes, as spot instances if a price is given, while
+# input_launch starts the input node. Gives up on the input node too when
+# the spot requests are abandoned.
+def launch_compute(conn, opts, cluster_name, image, compute_group, block_map,
+                   zones, input_launch):
+  launch_groups = opts.compute_groups + 1
+  if opts.spot_price != None:
+    # Launch spot instances with the requested price
+    my_req_ids = request_spot(conn, opts, cluster_name, compute_group, block_map,
+                              launch_groups * opts.slaves, zones)
+
+    log("Waiting for spot instances to be granted...")
+    wanted = opts.slaves * launch_groups
+    try:
+      (active_instance_ids, open_req_ids) = wait_for_spot_requests(
+          conn, opts, my_req_ids, wanted)
+      if open_req_ids != []:
+        log("Canceling %d unfilled spot instance requests" % len(open_req_ids))
+        active_instance_ids += cancel_spot_requests(conn, open_req_ids)
+    except:
+      log("Canceling spot instance requests")
+      conn.cancel_spot_instance_requests(my_req_ids)
+      abandon_input(input_launch)
+      # Log a warning if any of these requests actually launched instances:
+      (input_nodes, compute_nodes) = get_existing_cluster(
+          conn, opts, cluster_name, die_on_error=False)
+      running = len(input_nodes) + len(compute_nodes)
+      if running:
+        log("WARNING: %d instances are still running" % running, stderr)
+      sys.exit(0)
+    compute_nodes = []
+    if active_instance_ids != []:
+      for r in conn.get_all_instances(active_instance_ids):
+        compute_nodes += r.instances
+    missing = wanted - len(compute_nodes)
+    if missing > 0 and opts.spot_fallback == "on-demand":
+      log("Launching %d on-demand compute nodes in place of unfilled spot requests" % missing)
+      compute_nodes += launch_on_demand(conn, image, opts, compute_group, block_map,
+                                        missing, zones)
+    elif missing > 0 and opts.spot_fallback == "fewer-groups" and \
+        len(compute_nodes) >= 2 * opts.slaves:
+      groups = len(compute_nodes) / opts.slaves - 1
+      extra = compute_nodes[(groups + 1) * opts.slaves:]
+      compute_nodes = compute_nodes[:(groups + 1) * opts.slaves]
+      if extra != []:
+        conn.terminate_instances([i.id for i in extra])
+      log(("WARNING: continuing with %d of %d compute groups; " +
+           "pass -g %d to later commands") % (groups, opts.compute_groups, groups), stderr)
+      opts.compute_groups = groups
+    elif missing > 0:
+      log("ERROR: only %d of %d spot instances were granted" % (
+          len(compute_nodes), wanted), stderr)
+      if compute_nodes != []:
+        conn.terminate_instances([i.id for i in compute_nodes])
+      abandon_input(input_launch)
+      sys.exit(1)
+  else:
+    # Launch non-spot instances
+    compute_nodes = launch_on_demand(conn, image, opts, compute_group, block_map,
+                                     opts.slaves * launch_groups, zones)
+  return compute_nodes
+
+
 # Launch a cluster of the given name, by setting up its security groups,
 # and then starting new instances in them.
 # Returns a tuple of EC2 reservation objects for the master, slave
 # and zookeeper instances (in that order).
 # Fails if there already instances running in the cluster's groups.
+@traced("launch_cluster")
 def launch_cluster(conn, opts, cluster_name):
   print "Setting up security groups..."
   input_group = get_or_make_group(conn, cluster_name + "-input")
@@ -194,109 +637,168 @@ def launch_cluster(conn, opts, cluster_name):
     device.delete_on_termination = True
     block_map["/dev/sdv"] = device
   launch_groups = opts.compute_groups + 1
-  # Launch compute nodes
+  zones = get_zones(conn, opts)
+  if opts.zone == 'all':
+    opts.zone = random.choice(zones)
   if opts.spot_price != None:
-    # Launch spot instances with the requested price
     print ("Requesting %d compute nodes as spot instances with price $%.3f" %
            (launch_groups * opts.slaves, opts.spot_price))
-    zones = get_zones(conn, opts)
-    num_zones = len(zones)
-    i = 0
-    my_req_ids = []
-    for zone in zones:
-      num_slaves_this_zone = get_partition(launch_groups * opts.slaves, num_zones, i)
-      compute_reqs = conn.request_spot_instances(
-          price = opts.spot_price,
-          image_id = opts.ami,
-          launch_group = "launch-group-%s" % cluster_name,
-          placement = zone,
-          count = num_slaves_this_zone,
-          key_name = opts.key_pair,
-          security_groups = [compute_group],
-          instance_type = opts.instance_type,
-          block_device_map = block_map)
-      my_req_ids += [req.id for req in compute_reqs]
-      i += 1
-    
-    print "Waiting for spot instances to be granted..."
-    try:
-      while True:
-        time.sleep(10)
-        reqs = conn.get_all_spot_instance_requests()
-        id_to_req = {}
-        for r in reqs:
-          id_to_req[r.id] = r
-        active_instance_ids = []
-        for i in my_req_ids:
-          if i in id_to_req and id_to_req[i].state == "active":
-            active_instance_ids.append(id_to_req[i].instance_id)
-        if len(active_instance_ids) == opts.slaves * launch_groups:
-          print "All %d compute nodes granted" %(opts.slaves * launch_groups)
-          reservations = conn.get_all_instances(active_instance_ids)
-          compute_nodes = []
-          for r in reservations:
-            compute_nodes += r.instances
-          break
-        else:
-          print "%d of %d compute nodes granted, waiting longer" % (
-            len(active_instance_ids), opts.slaves * launch_groups)
-    except:
-      print "Canceling spot instance requests"
-      conn.cancel_spot_instance_requests(my_req_ids)
-      # Log a warning if any of these requests actually launched instances:
-      (input_nodes, compute_nodes) = get_existing_cluster(
-          conn, opts, cluster_name, die_on_error=False)
-      running = len(input_nodes) + len(compute_nodes)
-      if running:
-        print >> stderr, ("WARNING: %d instances are still running" % running)
-      sys.exit(0)
-  else:
-    # Launch non-spot instances
-    zones = get_zones(conn, opts)
-    num_zones = len(zones)
-    i = 0
-    compute_nodes = []
-    for zone in zones:
-      num_slaves_this_zone = get_partition(opts.slaves * launch_groups, num_zones, i)
-      if num_slaves_this_zone > 0:
-        compute_res = image.run(key_name = opts.key_pair,
-                              security_groups = [compute_group],
-                              instance_type = opts.instance_type,
-                              placement = zone,
-                              min_count = num_slaves_this_zone,
-                              max_count = num_slaves_this_zone,
-                              block_device_map = block_map)
-        compute_nodes += compute_res.instances
-        print "Launched %d compute nodes in %s, regid = %s" % (num_slaves_this_zone,
-                                                        zone, compute_res.id)
-      i += 1
-
-  # Launch input nodes
-  input_type = opts.instance_type
-  if input_type == "":
-    input_type = opts.instance_type
-  if opts.zone == 'all':
-    opts.zone = random.choice(conn.get_all_zones()).name
-  input_res = image.run(key_name = opts.key_pair,
-                         security_groups = [input_group],
-                         instance_type = input_type,
-                         placement = opts.zone,
-                         min_count = 1,
-                         max_count = 1,
-                         block_device_map = block_map)
-  input_nodes = input_res.instances
-  print "Launched input in %s, regid = %s" % (zone, input_res.id)
+  # The input node is launched while the compute nodes are
+  input_launch = start_call(launch_input, image, opts, input_group, block_map)
+  try:
+    compute_nodes = launch_compute(conn, opts, cluster_name, image, compute_group,
+                                   block_map, zones, input_launch)
+  except Exception:
+    abandon_input(input_launch)
+    raise
+  try:
+    input_nodes = input_launch.get()
+  except Exception:
+    if compute_nodes != []:
+      conn.terminate_instances([i.id for i in compute_nodes])
+    raise
 
   # Return all the instances
   return (input_nodes, compute_nodes)
 
 
-# Get the EC2 instances in an existing cluster if available.
-# Returns a tuple of lists of EC2 instance objects for the masters,
-# slaves and zookeeper nodes (in that order).
-def get_existing_cluster(conn, opts, cluster_name, die_on_error=True):
+# The local cluster state file remembers which instances make up a cluster
+# and their roles, so later actions can look them up by id instead of
+# searching the account.
+def cluster_state_file(opts, cluster_name, kind="json"):
+  return os.path.join(os.path.expanduser(opts.state_dir),
+                      "%s-%s.%s" % (opts.region, cluster_name, kind))
+
+
+# Role of each instance, by position: one input node, then the redis group
+# and the compute groups, opts.slaves nodes each
+def cluster_roles(opts, input_nodes, compute_nodes):
+  roles = {}
+  for i in input_nodes:
+    roles[i.id] = "input"
+  for n in xrange(0, len(compute_nodes)):
+    group = n / opts.slaves if opts.slaves > 0 else 0
+    roles[compute_nodes[n].id] = "redis" if group == 0 else "compute-%d" % (group - 1)
+  return roles
+
+
+# Tag instances with their cluster and role, so that discovery can restore
+# the order of the compute groups. Tagging right after launch can race
+# with the instances becoming visible, so it is retried a few times.
+@traced("tag_cluster")
+def tag_cluster(conn, opts, cluster_name, input_nodes, compute_nodes):
+  by_role = {}
+  for (id, role) in cluster_roles(opts, input_nodes, compute_nodes).items():
+    by_role.setdefault(role, []).append(id)
+  delays = backoff_delays()
+  for (role, ids) in sorted(by_role.items()):
+    tries = 0
+    while True:
+      try:
+        conn.create_tags(ids, {"smpc-cluster": cluster_name, "smpc-role": role})
+        break
+      except boto.exception.EC2ResponseError as e:
+        if tries > 2:
+          print >> stderr, "WARNING: could not tag %s nodes: %s" % (role, e)
+          break
+        time.sleep(next(delays))
+        tries += 1
+
+
+# Sort key putting the redis group before compute groups 0, 1, ...
+def role_order(instance):
+  role = instance.tags.get("smpc-role", "")
+  if role == "redis":
+    return -1
+  return int(role[len("compute-"):])
+
+
+def save_cluster_state(opts, cluster_name, input_nodes, compute_nodes):
+  state = {
+    "cluster": cluster_name,
+    "region": opts.region,
+    "input": [i.id for i in input_nodes],
+    "compute": [i.id for i in compute_nodes],
+    "roles": cluster_roles(opts, input_nodes, compute_nodes)
+  }
+  path = cluster_state_file(opts, cluster_name)
+  try:
+    if not os.path.isdir(os.path.dirname(path)):
+      os.makedirs(os.path.dirname(path))
+    with open(path + ".tmp", "w") as f:
+      json.dump(state, f, indent=2, sort_keys=True)
+    os.rename(path + ".tmp", path)
+  except (IOError, OSError) as e:
+    print >> stderr, "WARNING: could not save cluster state to %s: %s" % (path, e)
+
+
+def forget_cluster_state(opts, cluster_name):
+  for kind in ("json", "setup.json"):
+    path = cluster_state_file(opts, cluster_name, kind)
+    if os.path.exists(path):
+      os.remove(path)
+
+
+# The setup record maps each instance id to a hash of everything its setup
+# was rendered from (see setup_stamp), so later setups can skip hosts
+# whose inputs have not changed.
+def load_setup_stamps(opts, cluster_name):
+  try:
+    with open(cluster_state_file(opts, cluster_name, "setup.json")) as f:
+      return json.load(f)
+  except (IOError, ValueError):
+    return {}
+
+
+def save_setup_stamps(opts, cluster_name, stamps):
+  path = cluster_state_file(opts, cluster_name, "setup.json")
+  try:
+    if not os.path.isdir(os.path.dirname(path)):
+      os.makedirs(os.path.dirname(path))
+    with open(path + ".tmp", "w") as f:
+      json.dump(stamps, f, indent=2, sort_keys=True)
+    os.rename(path + ".tmp", path)
+  except (IOError, OSError) as e:
+    print >> stderr, "WARNING: could not save setup state to %s: %s" % (path, e)
+
+
+def setup_stamp(*inputs):
+  return hashlib.sha1(json.dumps(inputs, sort_keys=True)).hexdigest()
+
+
+# Look up the instances recorded in the cluster state file with a single
+# describe call. Returns empty lists if there is no state or it is stale,
+# i.e. some instance is gone or no longer in the cluster's groups.
+def load_cluster_state(conn, opts, cluster_name):
+  path = cluster_state_file(opts, cluster_name)
+  if opts.refresh or not os.path.exists(path):
+    return ([], [])
+  try:
+    with open(path) as f:
+      state = json.load(f)
+    ids = state["input"] + state["compute"]
+    found = {}
+    for res in conn.get_all_instances(instance_ids=ids):
+      for i in res.instances:
+        found[i.id] = (i, [g.name for g in res.groups])
+  except (IOError, ValueError, KeyError, boto.exception.EC2ResponseError):
+    return ([], [])
+  for (ids, group) in ((state["input"], "-input"), (state["compute"], "-compute")):
+    for id in ids:
+      if id not in found or not is_active(found[id][0]) or \
+          found[id][1] != [cluster_name + group]:
+        return ([], [])
+  return ([found[id][0] for id in state["input"]],
+          [found[id][0] for id in state["compute"]])
+
+
+# Find a cluster's instances by asking EC2 only for active instances in
+# its security groups
+def discover_cluster(conn, opts, cluster_name):
   print "Searching for existing cluster " + cluster_name + "..."
-  reservations = conn.get_all_instances()
+  reservations = conn.get_all_instances(filters={
+    "instance.group-name": [cluster_name + "-input", cluster_name + "-compute"],
+    "instance-state-name": ["pending", "running", "stopping", "stopped"]})
   input_nodes = []
   compute_nodes = []
   for res in reservations:
@@ -304,9 +806,26 @@ def get_existing_cluster(conn, opts, cluster_name, die_on_error=True):
     if len(active) > 0:
       group_names = [g.name for g in res.groups]
       if group_names == [cluster_name + "-input"]:
-        input_nodes += res.instances
+        input_nodes += active
       elif group_names == [cluster_name + "-compute"]:
-        compute_nodes += res.instances
+        compute_nodes += active
+  roles = [i.tags.get("smpc-role", "") for i in compute_nodes]
+  if all(r == "redis" or r.startswith("compute-") for r in roles):
+    compute_nodes.sort(key=role_order)
+  return (input_nodes, compute_nodes)
+
+
+# Get the EC2 instances in an existing cluster if available, from the local
+# cluster state when it is still valid and by searching EC2 otherwise.
+# Returns a tuple of lists of EC2 instance objects for the input and
+# compute nodes (in that order).
+@traced("find_cluster")
+def get_existing_cluster(conn, opts, cluster_name, die_on_error=True):
+  (input_nodes, compute_nodes) = load_cluster_state(conn, opts, cluster_name)
+  if input_nodes == [] or compute_nodes == []:
+    (input_nodes, compute_nodes) = discover_cluster(conn, opts, cluster_name)
+    if input_nodes != [] and compute_nodes != []:
+      save_cluster_state(opts, cluster_name, input_nodes, compute_nodes)
   if any((input_nodes, compute_nodes)):
     print ("Found %d input(s), %d computes" %
            (len(input_nodes), len(compute_nodes)))
@@ -322,10 +841,359 @@ def get_existing_cluster(conn, opts, cluster_name, die_on_error=True):
     sys.exit(1)
 
 
+# Wait for a host to accept TCP connections on the SSH port and, with
+# --probe-ssh, to run a trivial command. Returns False if the host is still
+# not ready at the deadline.
+def probe_host(host, opts, deadline):
+  delays = backoff_delays(1, 10)
+  while True:
+    if opts.hosts.probe(host):
+      return True
+    if time.time() >= deadline:
+      return False
+    time.sleep(min(next(delays), max(0, deadline - time.time())))
+
+
+# Probe all hosts at once. Returns a queue that receives a (host, ready)
+# pair for every host as soon as it is ready or has timed out.
+def probe_hosts(opts, hosts):
+  ready = Queue.Queue()
+  deadline = time.time() + opts.launch_timeout
+  def probe(host):
+    with timed("probe", host):
+      ok = probe_host(host, opts, deadline)
+    ready.put((host, ok))
+  for host in set(hosts):
+    t = threading.Thread(target=probe, args=(host,))
+    t.daemon = True
+    t.start()
+  return ready
+
+
+# Run jobs, a list of (host, function) pairs, on up to opts.parallelism
+# threads. A job starts once its host has come out of the ready queue (see
+# probe_hosts) or is in probed, a list of (host, ready) pairs already taken
+# off that queue; without a queue every job starts right away. A failing
+# job does not stop the others; failures are returned as (host, exception)
+# pairs once every job has finished.
+def run_parallel(opts, jobs, ready=None, probed=[]):
+  def run(job):
+    (host, fn) = job
+    try:
+      with timed("setup_host", host):
+        fn()
+      return None
+    except Exception as e:
+      log("ERROR: setting up %s failed: %s" % (host, e), stderr)
+      return (host, e)
+  if jobs == []:
+    return []
+  waiting = {}
+  for (host, fn) in jobs:
+    waiting.setdefault(host, []).append(fn)
+  if ready == None:
+    probed = [(host, True) for host in waiting]
+  probed = list(probed)
+  pool = ThreadPool(max(1, min(opts.parallelism, len(jobs))))
+  results = []
+  failures = []
+  try:
+    while waiting != {}:
+      if probed != []:
+        (host, ok) = probed.pop(0)
+      else:
+        (host, ok) = ready.get()
+      if not ok and host in waiting:
+        log("ERROR: %s did not become reachable" % host, stderr)
+        waiting.pop(host)
+        failures.append((host, Exception("not reachable over SSH")))
+        continue
+      for fn in waiting.pop(host, []):
+        results.append(pool.apply_async(run, ((host, fn),)))
+  finally:
+    pool.close()
+    pool.join()
+  return failures + [r.get() for r in results if r.get() != None]
+
+
+# The files each host needs are rendered here as (name, contents, mode)
+# tuples, relative to the home directory, and pushed in a single bundle.
+# Scripts keep a literal $GOPATH, filled in from the host's environment
+# when the bundle is unpacked.
+def render_master(master, opts, redis_group, groups, compute_nodes):
+  files = []
+  files.append(("run-smpc", """#!/bin/zsh 
+$GOPATH/bin/input --config="$HOME/input-config.json"
+""", 0755))
+  files.append(("hosts", '\n'.join(map(lambda c: c.private_ip_address, filter(lambda n: n not in redis_group, compute_nodes))) + '\n', 0644))
+  files.append(("redis-hosts", '\n'.join(map(lambda c: c.private_ip_address, redis_group)) + '\n', 0644))
+  pub_port = 4000
+  for group_config in xrange(0, len(groups)):
+    config = {
+      "PubAddress": "tcp://*:%d" % pub_port,
+      "ControlAddress": "tcp://*:%d" % (pub_port + 1),
+      "Clients": opts.slaves,
+      "Shell": True
+    }
+    files.append(("input-config-%d.json" % group_config, json.dumps(config, indent=2, sort_keys=True, separators=(',', ': ')) + '\n', 0644))
+    pub_port += 2
+  configs = ' '.join(map(lambda c:"$HOME/input-config-%d.json"%c, xrange(0, len(groups))))
+  files.append(("test-smpc", str.format("""#!/bin/zsh 
+parallel-ssh -h ~/redis-hosts sudo ~/launch-redis
+parallel-ssh -h ~/hosts ~/run-smpc
+$GOPATH/bin/input --config="{0}" --topo=$1 --dest=$2 1&>2 | tee smpc.out
+echo Killing compute
+parallel-ssh -h ~/hosts killall compute &> compute.out
+echo Killing redis
+parallel-ssh -h ~/redis-hosts sudo killall redis-server &> redis-server.out
+""", configs), 0755))
+  return files
+
+
+def render_redis(node):
+  return [("launch-redis", "sudo redis-server /etc/redis/redis.conf\n", 0755)]
+
+
+# Files for compute node i of a group whose input node publishes on pub_port
+def render_compute(master, i, group, pub_port, redis_group):
+  config = {
+    "PubAddress": "tcp://%s:%d" % (master, pub_port),
+    "ControlAddress": "tcp://%s:%d" % (master, pub_port + 1),
+    "Clients": map(lambda c: "tcp://%s:5001" % c.private_ip_address, group),
+    "Databases": map(lambda c: {"Address": "%s:6379" % c.private_ip_address, "Database": 1}, redis_group)
+  }
+  return [
+    ("compute-config.json", json.dumps(config, indent=2, sort_keys=True, separators=(',', ': ')) + '\n', 0644),
+    ("run-smpc", str.format("""#!/bin/zsh
+$GOPATH/bin/compute --config="$HOME/compute-config.json" --peer={0} &> peer{0}.out &
+""", i), 0755)]
+
+
+# Pack rendered files into a gzipped tar
+def make_bundle(files):
+  buf = StringIO()
+  tar = tarfile.open(fileobj=buf, mode="w:gz")
+  for (name, contents, mode) in files:
+    info = tarfile.TarInfo(name)
+    info.size = len(contents)
+    info.mode = mode
+    info.mtime = time.time()
+    tar.addfile(info, StringIO(contents))
+  tar.close()
+  return buf.getvalue()
+
+
+# Send a host its files in one ssh round trip. They are unpacked into a
+# scratch directory and then renamed into place, so a host never sees a
+# half-written file.
+def push_bundle(host, opts, files):
+  names = ' '.join(name for (name, contents, mode) in files)
+  ssh(host, opts, ("rm -rf ~/.smpc-bundle && mkdir ~/.smpc-bundle && " +
+                   "tar -xzf - -C ~/.smpc-bundle && cd ~/.smpc-bundle && " +
+                   "sed -i \"s|[$]GOPATH|$GOPATH|g\" %s && mv -f %s ~/ && " +
+                   "cd && rmdir ~/.smpc-bundle") % (names, names),
+      stdin_data=make_bundle(files))
+
+
+# Configure the input (master) node: build SMPC, install its scripts,
+# host lists and per-group input configs, and sync the topology.
+def setup_master(master, opts, files, known_hosts, topo_hashes):
+  ssh(master, opts, 'go get -u github.com/apanda/smpc/...') 
+  push_bundle(master, opts, files)
+  # parallel-ssh in test-smpc needs the other hosts' keys to be known.
+  # Older keys for the same addresses (from earlier setups, or instances
+  # that had them before) are removed first, so entries don't pile up.
+  ssh(master, opts, ("for h in %s; do ssh-keygen -R $h -f ~/.ssh/known_hosts >/dev/null 2>&1; done; " +
+                     "ssh-keyscan -H %s >> ~/.ssh/known_hosts 2>/dev/null") %
+      (' '.join(known_hosts), ' '.join(known_hosts)))
+  if opts.topo != "":
+    sync_topology(master, opts, topo_hashes)
+
+
+# Configure a node of the redis group
+def setup_redis(node, opts, files):
+  push_bundle(node.public_dns_name, opts, files)
+
+
+# Configure a compute node, building SMPC on it through the master unless
+# the master's binaries are distributed afterwards
+def setup_compute(master, node, opts, files):
+  if opts.distribute == "build":
+    ssh(master, opts, str.format("ssh -o StrictHostKeyChecking=no {0}@{1} go get -u github.com/apanda/smpc/...", opts.user, node.private_ip_address))
+  push_bundle(node.public_dns_name, opts, files)
+
+
+# Shell script run on the master for one round of a fan-out. Each
+# (src, dst) pair copies tarball to dst, from the master itself when src
+# is "-" and otherwise from src, which reaches dst with the master's key
+# through a forwarded agent, and unpacks it into dest there. A line
+# "ok <dst>" is printed for every copy that succeeded.
+def fanout_script(opts, sends, tarball, dest):
+  script = """eval $(ssh-agent -s) > /dev/null
+ssh-add -q ~/.ssh/id_rsa
+O="-o StrictHostKeyChecking=no -o BatchMode=yes"
+send() {
+  if [ "$1" = - ]; then
+    scp -q $O ~/%(tarball)s %(user)s@$2:
+  else
+    ssh -A $O %(user)s@$1 "scp -q $O %(tarball)s %(user)s@$2:"
+  fi &&
+  ssh $O %(user)s@$2 'mkdir -p %(dest)s && tar -xzf %(tarball)s -C %(dest)s' &&
+  echo "ok $2" || echo "ERROR: copying %(tarball)s from $1 to $2 failed" >&2
+}
+""" % {"tarball": tarball, "user": opts.user, "dest": dest}
+  for (src, dst) in sends:
+    script += "send %s %s &\n" % (src, dst)
+  return script + "wait\nssh-agent -k > /dev/null\n"
+
+
+# Copy a tarball on the master to hosts (private addresses) over a tree,
+# unpacking it into dest on each: in every round each host that already
+# has it, the master included, copies it to one host that does not, so
+# the number of rounds grows with log(N). Returns failures as
+# (host, exception) pairs.
+def fan_out(master, opts, hosts, tarball, dest, what):
+  print "Copying %s from master to %d hosts..." % (what, len(hosts))
+  holders = ["-"]
+  pending = list(hosts)
+  failures = []
+  rounds = 0
+  while pending != []:
+    sends = zip(holders, pending)
+    pending = pending[len(sends):]
+    with timed("fanout_round", round=rounds, copies=len(sends)):
+      out = ssh(master, opts, "sh -s", stdin_data=fanout_script(opts, sends, tarball, dest),
+                output=True)
+    done = set(l.split()[1] for l in out.splitlines() if l.startswith("ok "))
+    for (src, dst) in sends:
+      if dst in done:
+        holders.append(dst)
+      else:
+        failures.append((dst, Exception("%s could not be copied" % what)))
+    rounds += 1
+  print "Copied %s to %d hosts in %d rounds" % (what, len(holders) - 1, rounds)
+  return failures
+
+
+# Copy the binaries built on the master to hosts
+@traced("distribute")
+def distribute_binaries(master, opts, hosts):
+  ssh(master, opts, "tar -czf ~/%s -C $GOPATH/bin %s" % (BINARY_TARBALL, ' '.join(BINARIES)))
+  return fan_out(master, opts, hosts, BINARY_TARBALL, "$GOPATH/bin", "binaries")
+
+
+# Copy the topology, as synced to the master, to hosts
+@traced("distribute_topology")
+def distribute_topology(master, opts, hosts):
+  ssh(master, opts, "tar -czf ~/%s -C ~ %s" % (TOPO_TARBALL, topology_name(opts)))
+  return fan_out(master, opts, hosts, TOPO_TARBALL, "~", "topology")
+
+
+# The topology is kept under its own name in the home directory of the
+# hosts that get it, as scp -r would put it
+def topology_name(opts):
+  return os.path.basename(os.path.normpath(opts.topo))
+
+
+# SHA-1 of every file of the topology (a single file or a directory tree),
+# by path relative to the topology's parent directory
+def topology_hashes(opts):
+  parent = os.path.dirname(os.path.abspath(opts.topo))
+  paths = [os.path.abspath(opts.topo)]
+  if os.path.isdir(opts.topo):
+    paths = [os.path.join(root, f) for (root, dirs, files) in os.walk(opts.topo)
+             for f in files]
+  hashes = {}
+  for path in paths:
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+      while True:
+        chunk = f.read(1 << 20)
+        if not chunk:
+          break
+        h.update(chunk)
+    hashes[os.path.relpath(os.path.abspath(path), parent)] = h.hexdigest()
+  return hashes
+
+
+# Bring the topology on the master up to date with the local one: only
+# files whose hashes differ from those on the master are sent, as one
+# compressed tarball. Files under the topology on the master that the local
+# one does not have are deleted, so a stale part file is never read.
+@traced("sync_topology")
+def sync_topology(master, opts, hashes):
+  name = topology_name(opts)
+  out = ssh(master, opts, ("cd ~ && if [ -e %s ]; then find %s -type f " +
+                           "-exec sha1sum {} +; fi") % (name, name), output=True)
+  remote = {}
+  for l in out.splitlines():
+    p = l.split(None, 1)
+    if len(p) == 2:
+      remote[p[1]] = p[0]
+  stale = sorted(path for path in remote if path not in hashes)
+  if stale != []:
+    print "Removing %d stale topology files from master..." % len(stale)
+    ssh(master, opts, "cd ~ && xargs -0 rm -f --", stdin_data='\0'.join(stale))
+  changed = sorted(path for path in hashes if remote.get(path) != hashes[path])
+  if changed == []:
+    print "Topology on master is up to date"
+    return
+  print "Uploading %d of %d topology files to master..." % (len(changed), len(hashes))
+  parent = os.path.dirname(os.path.abspath(opts.topo))
+  (fd, tmp) = tempfile.mkstemp(suffix=".tgz")
+  os.close(fd)
+  try:
+    tar = tarfile.open(tmp, "w:gz", compresslevel=1)
+    for path in changed:
+      tar.add(os.path.join(parent, path), path)
+    tar.close()
+    scp(master, opts, tmp, "~/" + TOPO_TARBALL)
+  finally:
+    os.remove(tmp)
+  ssh(master, opts, "tar -xzf ~/%s -C ~ && rm ~/%s" % (TOPO_TARBALL, TOPO_TARBALL))
+
+
 # Deploy configuration files and run setup scripts on a newly launched
-# or started EC2 cluster.
-def setup_cluster(conn, input_nodes, compute_nodes, opts, deploy_ssh_key):
+# or started EC2 cluster. Every host is configured concurrently, up to
+# opts.parallelism at a time, over one shared SSH connection per host.
+@traced("setup_cluster")
+def setup_cluster(conn, cluster_name, input_nodes, compute_nodes, opts, deploy_ssh_key):
+  open_ssh_pool(opts)
+  try:
+    configure_cluster(cluster_name, input_nodes, compute_nodes, opts, deploy_ssh_key)
+  finally:
+    close_ssh_pool(opts)
+
+
+# Look up the SMPC revision go get would fetch, or None if that fails
+def smpc_revision(master, opts):
+  try:
+    out = ssh(master, opts, "git ls-remote %s HEAD" % SMPC_REPO, output=True)
+  except subprocess.CalledProcessError:
+    return None
+  if not out.split():
+    return None
+  return out.split()[0]
+
+
+# Hosts are only set up again if something their setup depends on, i.e.
+# their rendered files, the SMPC revision and for the master the topology,
+# differs from what the setup record says they were last set up with.
+def configure_cluster(cluster_name, input_nodes, compute_nodes, opts, deploy_ssh_key):
   master = input_nodes[0].public_dns_name
+  print "Waiting for SSH on %d hosts..." % (len(compute_nodes) + 1)
+  ready = probe_hosts(opts, [master] + map(lambda c: c.public_dns_name, compute_nodes))
+  # Other hosts that come up before the master are set up once it is
+  probed = []
+  while True:
+    (host, ok) = ready.get()
+    if host != master:
+      probed.append((host, ok))
+    elif ok:
+      break
+    else:
+      print >> stderr, "ERROR: master %s did not become reachable" % master
+      sys.exit(1)
   if deploy_ssh_key:
     print "Copying SSH key %s to master..." % opts.identity_file
     ssh(master, opts, 'mkdir -p ~/.ssh')
@@ -333,110 +1201,91 @@ def setup_cluster(conn, input_nodes, compute_nodes, opts, deploy_ssh_key):
     ssh(master, opts, 'chmod 600 ~/.ssh/id_rsa')
 
     #ssh(master, opts, 'sudo apt-get install git')
-  ssh(master, opts, 'go get -u github.com/apanda/smpc/...') 
-  print compute_nodes
-  print input_nodes
-  print compute_nodes[0].public_dns_name
-  print len(compute_nodes)
-  ssh(master, opts, str.format("""cat >~/run-smpc <<EOF
-#!/bin/zsh 
-$GOPATH/bin/input --config="/home/ubuntu/input-config.json"
-EOF
-"""))
-  ssh(master, opts, "chmod 755 ~/run-smpc")
-  print compute_nodes
   print map(lambda c: c.private_ip_address, compute_nodes)
   ngroups = opts.compute_groups
   ncompute = opts.slaves
-  print ngroups
-  print ncompute
   groups = [[compute_nodes[group * ncompute + comp] for comp in xrange(0, opts.slaves)] for group in xrange(0, ngroups + 1)]
-  print groups
   assert(len(groups) > 1) # make sure there is a redis group
   redis_group = groups[0]
   groups = groups[1:]
-  redis_ips = ",".join(map(lambda c: str.format("{{\"Address\":\"{0}:6379\", \"Database\":1}}", c.private_ip_address), redis_group))
-  print groups
-  print str.format("Redis IPs: {0}", redis_ips)
+  print str.format("Redis IPs: {0}", map(lambda c: c.private_ip_address, redis_group))
   print str.format("Private IPs = {0}", map(lambda c: c.private_ip_address, filter(lambda n: n not in redis_group, compute_nodes)))
-  ssh(master, opts, str.format("""cat >~/hosts <<EOF
-{0}
-EOF
-""", '\n'.join(map(lambda c: c.private_ip_address, filter(lambda n: n not in redis_group, compute_nodes)))))
-  ssh(master, opts, str.format("""cat >~/redis-hosts <<EOF
-{0}
-EOF
-""", '\n'.join(map(lambda c: c.private_ip_address, redis_group))))
+  known_hosts = map(lambda c: c.private_ip_address, compute_nodes)
+  rev = smpc_revision(master, opts)
+  stamps = {}
+  if rev == None:
+    print >> stderr, "WARNING: could not look up the SMPC revision, setting up every host"
+  elif not opts.full_setup:
+    stamps = load_setup_stamps(opts, cluster_name)
+  topo_hashes = {}
+  if opts.topo != "":
+    topo_hashes = topology_hashes(opts)
+  topo = setup_stamp(sorted(topo_hashes.items()))
+  # Compute nodes only depend on the topology if they get a copy
+  compute_topo = topo if opts.topo != "" and opts.topo_to_compute else ""
+  # (instance, host, setup function, stamp) for every host
+  hosts = []
+  master_files = render_master(master, opts, redis_group, groups, compute_nodes)
+  hosts.append((input_nodes[0], master,
+                lambda: setup_master(master, opts, master_files, known_hosts, topo_hashes),
+                setup_stamp(master_files, known_hosts, topo, rev, opts.distribute)))
+  for node in redis_group:
+    files = render_redis(node)
+    hosts.append((node, node.public_dns_name,
+                  lambda node=node, files=files: setup_redis(node, opts, files),
+                  setup_stamp(files, rev, opts.distribute, compute_topo)))
   pub_port = 4000
-  group_config = 0
-  print redis_group, len(redis_group)
-  for i in xrange(0, len(redis_group)):
-      print "Writing to redis"
-      ssh(redis_group[i].public_dns_name, opts, str.format("""cat >~/launch-redis <<EOF
-sudo redis-server /etc/redis/redis.conf
-EOF
-""", redis_group[i].private_ip_address))
-      ssh(master, opts, str.format("""ssh -o StrictHostKeyChecking=no ubuntu@{0} chmod 755 ~/launch-redis 
-""", redis_group[i].private_ip_address))
   for group in groups:
-      compute_nodes = group
-      computes = ",\n".join(map(lambda c: str.format("\"tcp://{0}:5001\"", c.private_ip_address), compute_nodes))
-      ssh(master, opts, str.format("""cat >~/input-config-{3}.json <<EOF
-{{
-  "PubAddress": "tcp://*:{1}",
-  "ControlAddress" : "tcp://*:{2}",
-  "Clients": {0},
-  "Shell": true
-}}
-EOF
-    """, ncompute, pub_port, pub_port + 1, group_config))
-      for i in xrange(0, len(compute_nodes)):
-        ssh(master, opts, str.format("ssh -o StrictHostKeyChecking=no ubuntu@{0} go get -u github.com/apanda/smpc/...", compute_nodes[i].private_ip_address))
-        ssh(compute_nodes[i].public_dns_name, opts, str.format("""cat >~/compute-config.json <<EOF
-{{
-  "PubAddress": "tcp://{1}:{2}",
-  "ControlAddress" : "tcp://{1}:{3}",
-  "Clients" : [
-  {0}
-  ],
-  "Databases" : [{4}]
-}}
-EOF
-    """, computes, str(master), pub_port, pub_port + 1, redis_ips))
-        ssh(compute_nodes[i].public_dns_name, opts, str.format("""cat >~/run-smpc <<EOF
-#!/bin/zsh
-$GOPATH/bin/compute --config="/home/ubuntu/compute-config.json" --peer={0} &> peer{0}.out &
-EOF
-""", i))
-        ssh(compute_nodes[i].public_dns_name, opts, "chmod 755 ~/run-smpc")
-      pub_port += 2
-      group_config += 1
-
-  
-  configs = ' '.join(map(lambda c:"/home/ubuntu/input-config-%d.json"%c, xrange(0, group_config)))
-  ssh(master, opts, str.format("""cat >~/test-smpc <<EOF
-#!/bin/zsh 
-parallel-ssh -h ~/redis-hosts sudo ~/launch-redis
-parallel-ssh -h ~/hosts ~/run-smpc
-$GOPATH/bin/input --config="{0}" --topo=\$1 --dest=\$2 1&>2 | tee smpc.out
-echo Killing compute
-parallel-ssh -h ~/hosts killall compute &> compute.out
-echo Killing redis
-parallel-ssh -h ~/redis-hosts sudo killall redis-server &> redis-server.out
-EOF
-""", configs))
-  ssh(master, opts, "chmod 755 ~/test-smpc")
-  if opts.topo != "":
-      scp_dir(master, opts, opts.topo, "~/") 
+    for i in xrange(0, len(group)):
+      files = render_compute(master, i, group, pub_port, redis_group)
+      hosts.append((group[i], group[i].public_dns_name,
+                    lambda node=group[i], files=files: setup_compute(master, node, opts, files),
+                    setup_stamp(files, rev, opts.distribute, compute_topo)))
+    pub_port += 2
+  changed = [h for h in hosts if stamps.get(h[0].id) != h[3]]
+  if len(changed) < len(hosts):
+    print "%d of %d hosts are unchanged since their last setup, skipping them" % (
+        len(hosts) - len(changed), len(hosts))
+  jobs = [(host, fn) for (inst, host, fn, stamp) in changed]
+  print "Configuring %d hosts, %d at a time..." % (len(jobs), opts.parallelism)
+  failures = run_parallel(opts, jobs, ready, [(master, True)] + probed)
+  failed = set(host for (host, e) in failures)
+  distributions = []
+  if opts.distribute == "fanout":
+    distributions.append(distribute_binaries)
+  if compute_topo != "":
+    distributions.append(distribute_topology)
+  for distribute in distributions:
+    if master in failed:
+      failed.update(inst.private_ip_address for (inst, host, fn, stamp) in changed)
+      break
+    targets = [inst.private_ip_address for (inst, host, fn, stamp) in changed
+               if host != master and host not in failed and
+                  inst.private_ip_address not in failed]
+    if targets != []:
+      failures += distribute(master, opts, targets)
+      failed.update(host for (host, e) in failures)
+  for (inst, host, fn, stamp) in changed:
+    if host not in failed and inst.private_ip_address not in failed:
+      stamps[inst.id] = stamp
+  save_setup_stamps(opts, cluster_name, stamps)
+  if failures != []:
+    print >> stderr, "ERROR: setup failed on %d of %d hosts:" % (len(failures), len(jobs))
+    for (host, e) in failures:
+      print >> stderr, "  %s: %s" % (host, e)
+    sys.exit(1)
 
-# Wait for a whole cluster (masters, slaves and ZooKeeper) to start up
-def wait_for_cluster(conn, wait_secs, input_nodes, compute_nodes):
+# Wait for a whole cluster (input and compute nodes) to start up, returning
+# the nodes as last described. Whether they accept SSH yet is probed per
+# host by setup_cluster.
+def wait_for_cluster(conn, opts, input_nodes, compute_nodes):
   print "Waiting for instances to start up..."
-  time.sleep(5)
-  wait_for_instances(conn, input_nodes)
-  wait_for_instances(conn, compute_nodes)
-  print "Waiting %d more seconds..." % wait_secs
-  time.sleep(wait_secs)
+  nodes = wait_for_instances(conn, input_nodes + compute_nodes, opts.launch_timeout)
+  if opts.wait > 0:
+    print "Waiting %d more seconds..." % opts.wait
+    with timed("sleep"):
+      time.sleep(opts.wait)
+  return (nodes[:len(input_nodes)], nodes[len(input_nodes):])
 
 # Get number of local disks available for a given EC2 instance type.
 def get_num_disks(instance_type):
@@ -465,31 +1314,101 @@ def get_num_disks(instance_type):
 
 
 # Copy a file to a given host through scp, throwing an exception if scp fails
+@traced("scp", per_host=True)
 def scp(host, opts, local_file, dest_file):
-  subprocess.check_call(
-      "scp -q -o StrictHostKeyChecking=no -i %s '%s' '%s@%s:%s'" %
-      (opts.identity_file, local_file, 'ubuntu', host, dest_file), shell=True)
+  cmd = ("scp -q %s '%s' '%s@%s:%s'" %
+         (ssh_options(opts), local_file, opts.user, host, dest_file))
+  opts.hosts.copy(host, cmd)
 
-# Copy a file to a given host through scp, throwing an exception if scp fails
-def scp_dir(host, opts, local_file, dest_file):
-  subprocess.check_call(
-      "scp -q -o StrictHostKeyChecking=no -i %s -r '%s' '%s@%s:%s'" %
-      (opts.identity_file, local_file, 'ubuntu', host, dest_file), shell=True)
+# Options common to every ssh and scp command. While a connection pool is
+# open (see open_ssh_pool), the first connection to each host becomes a
+# ControlMaster that later commands and copies to that host reuse.
+def ssh_options(opts):
+  options = "-o StrictHostKeyChecking=no -i %s" % opts.identity_file
+  if getattr(opts, 'control_dir', None) != None:
+    options += (" -o ControlMaster=auto -o ControlPath=%s/%%r@%%h:%%p" +
+                " -o ControlPersist=%d") % (opts.control_dir, CONTROL_PERSIST)
+  return options
+
+
+# Start sharing one SSH connection per host between commands. The control
+# sockets live in a fresh directory under /tmp, which keeps their paths
+# short enough for a Unix socket.
+def open_ssh_pool(opts):
+  if opts.no_multiplex:
+    return
+  opts.control_dir = tempfile.mkdtemp(prefix="smpc-ssh-", dir="/tmp")
+
+
+# The hosts of a real cluster, reached over the network. connect() returns
+# one of these, or for --backend=sim the simulator, which has the same
+# probe, ssh and copy methods; probe_host, ssh and scp go through it as
+# opts.hosts.
+class SSHHosts(object):
+  def __init__(self, opts):
+    self.opts = opts
+
+  # Whether host accepts TCP connections on the SSH port and, with
+  # --probe-ssh, runs a trivial command
+  def probe(self, host):
+    try:
+      socket.create_connection((host, 22), PROBE_TIMEOUT).close()
+    except (socket.error, socket.timeout):
+      return False
+    if not self.opts.probe_ssh:
+      return True
+    with open(os.devnull, "w") as devnull:
+      return subprocess.call("ssh -T -o BatchMode=yes -o ConnectTimeout=%d %s %s@%s true" %
+                             (PROBE_TIMEOUT, ssh_options(self.opts), self.opts.user, host),
+                             shell=True, stdout=devnull, stderr=devnull) == 0
+
+  # Run an ssh command line, returning its output if output is set; raises
+  # subprocess.CalledProcessError if it fails
+  def ssh(self, host, command, stdin_data=None, output=False):
+    if stdin_data == None and not output:
+      return subprocess.check_call(command, shell=True)
+    proc = subprocess.Popen(command, shell=True, stdin=subprocess.PIPE,
+                            stdout=(subprocess.PIPE if output else None))
+    (out, _) = proc.communicate(stdin_data)
+    if proc.returncode != 0:
+      raise subprocess.CalledProcessError(proc.returncode, command)
+    return out
+
+  # Run an scp command line
+  def copy(self, host, command):
+    subprocess.check_call(command, shell=True)
+
+
+# Shut down the shared connections opened since open_ssh_pool
+def close_ssh_pool(opts):
+  control_dir = getattr(opts, 'control_dir', None)
+  if control_dir == None:
+    return
+  opts.control_dir = None
+  for sock in os.listdir(control_dir):
+    host = sock.split("@", 1)[-1].rsplit(":", 1)[0]
+    subprocess.call("ssh -o ControlPath='%s' -O exit %s 2>/dev/null" %
+                    (os.path.join(control_dir, sock), host), shell=True)
+  shutil.rmtree(control_dir, ignore_errors=True)
 
 
 # Run a command on a host through ssh, retrying up to two times
-# and then throwing an exception if ssh continues to fail.
-def ssh(host, opts, command):
+# and then throwing an exception if ssh continues to fail. No tty is
+# requested, since several of these run at once during setup. stdin_data,
+# if given, is fed to the command on every try. With output set, the
+# command's standard output is returned.
+@traced("ssh", per_host=True)
+def ssh(host, opts, command, stdin_data=None, output=False):
   tries = 0
   while True:
     try:
-      return subprocess.check_call(
-        "ssh -t -o StrictHostKeyChecking=no -i %s %s@%s '%s'" %
-        (opts.identity_file, 'ubuntu', host, command), shell=True)
+      cmd = "ssh -T %s %s@%s '%s'" % (ssh_options(opts), opts.user, host, command)
+      out = opts.hosts.ssh(host, cmd, stdin_data, output)
+      return out if output else 0
     except subprocess.CalledProcessError as e:
       if (tries > 2):
         raise e
-      print "Error connecting to host {0}, sleeping 30".format(e)
+      log("Error connecting to host {0}, sleeping 30".format(e))
       time.sleep(30)
       tries = tries + 1
 
@@ -510,10 +1429,47 @@ def get_partition(total, num_partitions, current_partitions):
   return num_slaves_this_zone
 
 
+# Connect to EC2 in the chosen region, or to --ec2-endpoint if given.
+# Returns the connection and the hosts to probe, run commands on and copy
+# files to (see SSHHosts). With --backend=sim both are a local simulator;
+# as it only lives as long as this process, its cluster state is kept in a
+# scratch directory.
+def connect(opts):
+  if opts.backend == "sim":
+    opts.state_dir = tempfile.mkdtemp(prefix="smpc-sim-")
+    atexit.register(shutil.rmtree, opts.state_dir, True)
+    sim = ec2sim.SimConnection(
+        boot_time=opts.sim_boot_time, spot_delay=opts.sim_spot_delay,
+        spot_fill=opts.sim_spot_fill, command_time=opts.sim_command_time,
+        failure_rate=opts.sim_failure_rate, seed=opts.sim_seed)
+    return (sim, sim)
+  if opts.ec2_endpoint == "":
+    return (ec2.connect_to_region(opts.region), SSHHosts(opts))
+  url = urlparse.urlparse(opts.ec2_endpoint)
+  region = RegionInfo(name=opts.region, endpoint=url.hostname)
+  return (ec2.connection.EC2Connection(region=region, port=url.port,
+                                       is_secure=(url.scheme == "https"),
+                                       path=url.path or "/"),
+          SSHHosts(opts))
+
+
+# Run the requested action, then print (and with --trace, write out) the
+# time spent in each phase
 def main():
   (opts, action, cluster_name) = parse_args()
+  if opts.trace != "":
+    TRACER.open(opts.trace, opts.trace_format)
+  try:
+    with timed(action):
+      run_action(opts, action, cluster_name)
+  finally:
+    TRACER.close()
+    print_trace_summary()
+
+
+def run_action(opts, action, cluster_name):
   try:
-    conn = ec2.connect_to_region(opts.region)
+    (conn, opts.hosts) = connect(opts)
   except Exception as e:
     print >> stderr, (e)
     sys.exit(1)
@@ -529,8 +1485,11 @@ def main():
     else:
       (input_nodes, compute_nodes) = launch_cluster(
           conn, opts, cluster_name)
-      wait_for_cluster(conn, opts.wait, input_nodes, compute_nodes)
-    setup_cluster(conn, input_nodes, compute_nodes, opts, True)
+      tag_cluster(conn, opts, cluster_name, input_nodes, compute_nodes)
+      save_cluster_state(opts, cluster_name, input_nodes, compute_nodes)
+      (input_nodes, compute_nodes) = wait_for_cluster(
+          conn, opts, input_nodes, compute_nodes)
+    setup_cluster(conn, cluster_name, input_nodes, compute_nodes, opts, True)
 
   elif action == "destroy":
     response = raw_input("Are you sure you want to destroy the cluster " +
@@ -545,6 +1504,7 @@ def main():
       print "Terminating slaves..."
       for inst in compute_nodes:
         inst.terminate()
+      forget_cluster_state(opts, cluster_name)
       
       # Delete security groups as well
       if opts.delete_groups:
@@ -597,7 +1557,7 @@ def main():
     if opts.proxy_port != None:
       proxy_opt = "-D " + opts.proxy_port
     subprocess.check_call("ssh -o StrictHostKeyChecking=no -i %s %s %s@%s" %
-        (opts.identity_file, proxy_opt, 'ubuntu', master), shell=True)
+        (opts.identity_file, proxy_opt, opts.user, master), shell=True)
 
   elif action == "get-master":
     (input_nodes, compute_nodes) = get_existing_cluster(conn, opts, cluster_name)
@@ -632,8 +1592,9 @@ def main():
     for inst in input_nodes:
       if inst.state not in ["shutting-down", "terminated"]:
         inst.start()
-    wait_for_cluster(conn, opts.wait, input_nodes, compute_nodes)
-    setup_cluster(conn, input_nodes, compute_nodes, opts, False)
+    (input_nodes, compute_nodes) = wait_for_cluster(
+        conn, opts, input_nodes, compute_nodes)
+    setup_cluster(conn, cluster_name, input_nodes, compute_nodes, opts, False)
 
   else:
     print >> stderr, "Invalid action: %s" % action
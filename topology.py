@@ -0,0 +1,339 @@
+"""Compact, array-backed loader for AS topology files.
+
+A topology file has one directed link per line: ``src dst rel`` where
+``rel`` is one of ``p2c``, ``p2p`` or ``c2p``.  Nodes are numbered densely
+from 1 in order of first appearance (``src`` before ``dst`` on each line),
+which is the numbering the SMPC binaries and result files use.  A node's
+ports follow the order its links appear in the file: port 0 is the node
+itself and port ``i`` is its ``i``-th neighbor.
+
+The loaded graph is kept in CSR form: ``offsets[v]:offsets[v + 1]`` slices
+``neighbors`` and ``rels`` for node ``v``.  Slot 0 of every per-node array is
+unused so node ids can index directly.
+
+``load`` keeps a binary copy of every parsed topology under ``CACHE_DIR``
+(``$SMIRC_TOPO_CACHE``), keyed by the file's path and checked against its
+size, mtime and SHA-1, so later loads map the arrays instead of re-parsing.
+"""
+import hashlib
+import json
+import os
+import sys
+import tempfile
+from array import array
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# 2-bit relationship codes, ordered clients, peers, providers
+P2C = 0
+P2P = 1
+C2P = 2
+REL_CODES = {'p2c': P2C, 'p2p': P2P, 'c2p': C2P}
+REL_NAMES = ['p2c', 'p2p', 'c2p']
+# EXPORT_RULES[a][b] is 1 when a route learned over a link of class a may be
+# exported over a link of class b: customer routes go everywhere, peer and
+# provider routes only go to customers.
+EXPORT_RULES = [[1, 1, 1],
+                [1, 0, 0],
+                [1, 0, 0]]
+
+
+class Topology(object):
+    def __init__(self, names, offsets, neighbors, rels):
+        # names[v] is the AS number (as a string) of node v; names[0] is None
+        self.names = names
+        self.offsets = offsets
+        self.neighbors = neighbors
+        self.rels = rels
+        self._ids = None
+        self._by_class = None
+
+    @property
+    def num_nodes(self):
+        return len(self.names) - 1
+
+    @property
+    def num_edges(self):
+        return len(self.neighbors)
+
+    def nodes(self):
+        return xrange(1, len(self.names))
+
+    def name(self, v):
+        return self.names[v]
+
+    def node_id(self, name):
+        # The reverse map is only needed by a few callers, build it lazily
+        if self._ids is None:
+            self._ids = dict((n, v) for v, n in enumerate(self.names) if v)
+        return self._ids[name]
+
+    def degree(self, v):
+        return self.offsets[v + 1] - self.offsets[v]
+
+    def links(self, v):
+        return self.neighbors[self.offsets[v]:self.offsets[v + 1]]
+
+    def relationships(self, v):
+        return self.rels[self.offsets[v]:self.offsets[v + 1]]
+
+    def ports_by_class(self, v):
+        """Ports of v ordered clients, peers, then providers, each in file order."""
+        # Sorted for every node at once, on first use
+        if self._by_class is None:
+            self._by_class = class_order(self.offsets, self.rels)
+        return self._by_class[self.offsets[v]:self.offsets[v + 1]]
+
+
+def _ndarray(a):
+    if isinstance(a, array):
+        return numpy.frombuffer(a, dtype=a.typecode)
+    return numpy.asarray(a, dtype=numpy.intp)
+
+
+def class_order(offsets, rels):
+    """For every node, its ports (1-based) in order of class, as one CSR array."""
+    if numpy is not None:
+        off = _ndarray(offsets)
+        src = numpy.repeat(numpy.arange(len(off) - 1), numpy.diff(off))
+        # lexsort is stable, so ports of a class keep their file order
+        order = numpy.lexsort((_ndarray(rels), src))
+        return (order - off[src] + 1).astype(numpy.int32)
+    ports = array('i')
+    for v in xrange(1, len(offsets) - 1):
+        start = offsets[v]
+        ports.extend(sorted(xrange(1, offsets[v + 1] - start + 1),
+                            key=lambda p: rels[start + p - 1]))
+    return ports
+
+
+def export_table(classes, neighbors):
+    """Dense export table for a node with the given per-port classes.
+
+    Row and column 0 are the node itself, row ``i`` says which ports a route
+    learned on port ``i`` may be exported to.  A route is never sent back
+    towards the neighbor it came from.
+    """
+    n = len(classes)
+    if numpy is not None:
+        c = _ndarray(classes)
+        nb = _ndarray(neighbors)
+        table = numpy.zeros((n + 1, n + 1), dtype=numpy.uint8)
+        table[:, 0] = 1
+        body = numpy.array(EXPORT_RULES, dtype=numpy.uint8)[c[:, None], c[None, :]]
+        body[nb[:, None] == nb[None, :]] = 0
+        table[1:, 1:] = body
+        return table.tolist()
+    rows = [[1] + [EXPORT_RULES[a][b] for b in classes] for a in xrange(3)]
+    ports = {}
+    for j in xrange(n):
+        ports.setdefault(neighbors[j], []).append(j + 1)
+    table = [[1] + [0] * n]
+    for i in xrange(n):
+        row = list(rows[classes[i]])
+        for j in ports[neighbors[i]]:
+            row[j] = 0
+        table.append(row)
+    return table
+
+
+def build(names, src, dst, rel):
+    """Build a Topology from parallel edge arrays, keeping file order per node."""
+    n = len(names) - 1
+    offsets = array('i', [0]) * (n + 2)
+    for s in src:
+        offsets[s + 1] += 1
+    for v in xrange(1, n + 2):
+        offsets[v] += offsets[v - 1]
+    fill = array('i', offsets)
+    neighbors = array('i', [0]) * len(src)
+    rels = array('B', [0]) * len(src)
+    for e in xrange(len(src)):
+        s = src[e]
+        pos = fill[s]
+        neighbors[pos] = dst[e]
+        rels[pos] = rel[e]
+        fill[s] = pos + 1
+    return Topology(names, offsets, neighbors, rels)
+
+
+def parse(f):
+    """Parse topology lines from an open file or other iterable."""
+    ids = {}
+    names = [None]
+    src = array('i')
+    dst = array('i')
+    rel = array('B')
+    for l in f:
+        p = l.split()
+        if not p:
+            continue
+        a = ids.get(p[0])
+        if a is None:
+            a = ids[p[0]] = len(names)
+            names.append(p[0])
+        b = ids.get(p[1])
+        if b is None:
+            b = ids[p[1]] = len(names)
+            names.append(p[1])
+        src.append(a)
+        dst.append(b)
+        rel.append(REL_CODES[p[2]])
+    topo = build(names, src, dst, rel)
+    topo._ids = ids
+    return topo
+
+
+# Parsed topologies are cached as one binary file per topology path: a magic
+# line, a JSON header line, then the raw offsets, neighbors, rels and names
+# arrays, each 8-byte aligned so they can be memory-mapped in place.
+CACHE_MAGIC = 'SMIRCTOPO1\n'
+CACHE_DIR = os.environ.get('SMIRC_TOPO_CACHE',
+    os.path.join(os.path.expanduser('~'), '.cache', 'smirc-tools', 'topology'))
+
+
+# A topology is either a single file or a directory of shards (as written by
+# generate_graph.py --shard-dir) that is read as their concatenation in
+# file name order.
+def source_files(path):
+    if os.path.isdir(path):
+        return [os.path.join(path, f) for f in sorted(os.listdir(path))
+                if not f.startswith('.')]
+    return [path]
+
+
+def _lines(files):
+    for name in files:
+        with open(name) as f:
+            for l in f:
+                yield l
+
+
+def file_hash(path):
+    h = hashlib.sha1()
+    for name in source_files(path):
+        h.update(os.path.basename(name))
+        with open(name, 'rb') as f:
+            while True:
+                chunk = f.read(1 << 20)
+                if not chunk:
+                    break
+                h.update(chunk)
+    return h.hexdigest()
+
+
+def cache_path(path):
+    return os.path.join(CACHE_DIR,
+        hashlib.sha1(os.path.abspath(path)).hexdigest() + '.topo')
+
+
+def _source_key(path):
+    stats = [os.stat(f) for f in source_files(path)]
+    return {'path': os.path.abspath(path),
+            'size': sum(st.st_size for st in stats),
+            'mtime': max([os.stat(path).st_mtime] + [st.st_mtime for st in stats]),
+            'byteorder': sys.byteorder}
+
+
+def write_cache(topo, path, key):
+    names = '\n'.join(topo.names[1:])
+    arrays = [('offsets', topo.offsets), ('neighbors', topo.neighbors),
+              ('rels', topo.rels)]
+    header = dict(key)
+    header['nodes'] = topo.num_nodes
+    header['sections'] = {}
+    pos = 0
+    for (name, a) in arrays:
+        typecode = a.typecode if isinstance(a, array) else a.dtype.char
+        header['sections'][name] = [pos, len(a), typecode]
+        pos += (len(a) * a.itemsize + 7) & ~7
+    header['sections']['names'] = [pos, len(names), 'c']
+    out = cache_path(path)
+    if not os.path.isdir(CACHE_DIR):
+        os.makedirs(CACHE_DIR)
+    (fd, tmp) = tempfile.mkstemp(dir=CACHE_DIR)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(CACHE_MAGIC)
+        f.write(json.dumps(header))
+        f.write('\n')
+        f.write('\0' * (-f.tell() & 7))
+        for (name, a) in arrays:
+            start = f.tell()
+            a.tofile(f)
+            f.write('\0' * (-(f.tell() - start) & 7))
+        f.write(names)
+    os.rename(tmp, out)
+
+
+def read_cache(path):
+    """Open a cache file, mapping its arrays with NumPy when available."""
+    with open(path, 'rb') as f:
+        if f.readline() != CACHE_MAGIC:
+            return (None, None)
+        header = json.loads(f.readline())
+        f.seek(-f.tell() & 7, os.SEEK_CUR)
+        base = f.tell()
+        arrays = {}
+        for name in ('offsets', 'neighbors', 'rels'):
+            (pos, length, typecode) = header['sections'][name]
+            if numpy is not None:
+                arrays[name] = numpy.memmap(path, dtype=typecode, mode='r',
+                                            offset=base + pos, shape=(length,))
+            else:
+                f.seek(base + pos)
+                arrays[name] = array(typecode)
+                arrays[name].fromfile(f, length)
+        (pos, length, _) = header['sections']['names']
+        f.seek(base + pos)
+        names = [None] + f.read(length).split('\n') if length else [None]
+    topo = Topology(names, arrays['offsets'], arrays['neighbors'], arrays['rels'])
+    return (header, topo)
+
+
+def load_cached(path):
+    key = _source_key(path)
+    cached = cache_path(path)
+    if os.path.exists(cached):
+        try:
+            (header, topo) = read_cache(cached)
+        except (IOError, ValueError, KeyError):
+            header = None
+        if header is not None and header['path'] == key['path'] and \
+                header['byteorder'] == key['byteorder'] and \
+                header['size'] == key['size']:
+            if header['mtime'] == key['mtime']:
+                return topo
+            # Touched but maybe not changed, compare contents
+            key['sha1'] = file_hash(path)
+            if header.get('sha1') == key['sha1']:
+                _try_write_cache(topo, path, key)
+                return topo
+    topo = parse(_lines(source_files(path)))
+    if 'sha1' not in key:
+        key['sha1'] = file_hash(path)
+    _try_write_cache(topo, path, key)
+    return topo
+
+
+def _try_write_cache(topo, path, key):
+    try:
+        write_cache(topo, path, key)
+    except (IOError, OSError) as e:
+        print >>sys.stderr, "Could not cache topology %s: %s" % (path, e)
+
+
+def load(path, cache=True):
+    """Load a topology file, going through the binary cache unless disabled."""
+    if cache:
+        return load_cached(path)
+    return parse(_lines(source_files(path)))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print >>sys.stderr, "Usage: %s topology" % (sys.argv[0])
+        sys.exit(1)
+    topo = load(sys.argv[1])
+    print "%d nodes %d links" % (topo.num_nodes, topo.num_edges)